@@ -9,7 +9,7 @@ Get information about what a frame is currently doing. Typical usage:
 
 from collections import namedtuple
 _VersionInfo = namedtuple('_VersionInfo', ('major', 'minor', 'micro'))
-from .executing import Source, Executing, only, NotOneValueFound, cache, future_flags
+from .executing import Source, Executing, ExecutingInfo, only, NotOneValueFound, cache, future_flags
 
 from ._pytest_utils import is_pytest_compatible
 
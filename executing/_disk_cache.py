@@ -0,0 +1,65 @@
+"""
+Opt-in storage of the data computed by `ModuleIndex` in files, see `Source.disk_cache_dir`.
+
+Files are named after a hash of the source text and the exact Python version,
+so they never need to be invalidated: a changed file or a different interpreter
+simply looks up a different name. They contain plain data serialized with `marshal`,
+which is fast and compact but specific to the Python version, and are written
+atomically with `os.replace` so that concurrent processes can share a directory.
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+from typing import Any, Optional
+
+# Increase when the format of the data saved by ModuleIndex changes
+FORMAT_VERSION = 1
+
+
+def cache_path(directory: str, text: str) -> str:
+    digest = hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+    return os.path.join(
+        directory,
+        "%s-%x-%d-%s.idx" % (sys.implementation.name, sys.hexversion, FORMAT_VERSION, digest),
+    )
+
+
+def load(directory: str, text: str) -> Optional[Any]:
+    """
+    Returns the data saved for `text`, or None if there is none or it can't be read.
+    """
+    try:
+        with open(cache_path(directory, text), "rb") as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def save(directory: str, text: str, data: Any) -> None:
+    """
+    Saves `data` for `text`, ignoring errors since the cache is only an optimisation.
+    """
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    except OSError:
+        return
+
+    replaced = False
+    try:
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(data, f)
+        os.replace(temp_path, cache_path(directory, text))
+        replaced = True
+    except (OSError, ValueError):
+        pass
+    finally:
+        # Don't leave the temporary file behind, whatever went wrong
+        if not replaced:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
@@ -1,14 +1,12 @@
 import ast
 import sys
 import dis
-from types import CodeType, FrameType
-from typing import Any, Callable, Iterator, Optional, Sequence, Set, Tuple, Type, Union, cast
-from .executing import EnhancedAST, NotOneValueFound, Source, only, function_node_types, assert_
+from types import CodeType
+from typing import Any, Callable, Iterator, NamedTuple, Optional, Sequence, Set, Tuple, Type, Union, cast
+from .executing import CodeInfo, EnhancedAST, Source, code_info, only, function_node_types, assert_
 from ._exceptions import KnownIssue, VerifierFailure
 from ._utils import mangled_name
 
-from functools import lru_cache
-import itertools
 
 # the code in this module can use all python>=3.11 features
 
@@ -27,9 +25,71 @@ def node_and_parents(node: EnhancedAST) -> Iterator[EnhancedAST]:
     yield from parents(node)
 
 
-@lru_cache(128) # pragma: no mutate
-def get_instructions(code: CodeType) -> list[dis.Instruction]:
-    return list(dis.get_instructions(code))
+class Instruction(NamedTuple):
+    """
+    The parts of a `dis.Instruction` that PositionNodeFinder uses,
+    see `decode_instruction`.
+    """
+
+    opname: str
+    opcode: int
+    arg: Optional[int]
+    argval: Any
+    argrepr: str
+    offset: int
+    positions: Optional[dis.Positions]
+
+
+jump_opcodes = set(getattr(dis, "hasjump", ())) | set(dis.hasjrel) | set(dis.hasjabs)
+
+
+def decode_instruction(code: CodeType, info: CodeInfo, index: int) -> Instruction:
+    """
+    Decodes the instruction at `info.instruction_offsets[index]` on its own,
+    by disassembling a copy of `code` holding just its bytes,
+    from any EXTENDED_ARGs before it up to the next instruction.
+    """
+    offsets = info.instruction_offsets
+    offset = offsets[index]
+    positions = dis.Positions(*info.positions[offset // 2])
+
+    start = index
+    while start > 0 and info.opnames[start - 1] == "EXTENDED_ARG":
+        start -= 1
+    begin = offsets[start]
+    end = offsets[index + 1] if index + 1 < len(offsets) else len(code.co_code)
+
+    try:
+        window = code.replace(
+            co_code=code.co_code[begin:end], co_linetable=b"", co_exceptiontable=b""
+        )
+        inst = list(dis.get_instructions(window))[-1]
+        ok = inst.offset == offset - begin and inst.opname == info.opnames[index]
+    except Exception:
+        ok = False
+
+    if not ok:
+        decode_all_instructions(code, info)
+        return info.decoded[offset]
+
+    argval, argrepr = inst.argval, inst.argrepr
+    if inst.opcode in jump_opcodes and isinstance(argval, int):
+        # Jump targets are relative to the window
+        argval += begin
+        argrepr = "to %d" % argval
+    return Instruction(inst.opname, inst.opcode, inst.arg, argval, argrepr, offset, positions)
+
+
+def decode_all_instructions(code: CodeType, info: CodeInfo) -> None:
+    """
+    Decodes every instruction of `code` into `info.decoded` in one pass.
+    """
+    info.decoded.update(
+        (inst.offset, Instruction(
+            inst.opname, inst.opcode, inst.arg, inst.argval, inst.argrepr, inst.offset, inst.positions
+        ))
+        for inst in dis.get_instructions(code)
+    )
 
 
 types_cmp_issue_fix = (
@@ -70,22 +130,21 @@ class PositionNodeFinder(object):
     There are only some exceptions for methods and attributes.
     """
 
-    def __init__(self, frame: FrameType, stmts: Set[EnhancedAST], tree: ast.Module, lasti: int, source: Source):
-        self.bc_dict={bc.offset:bc for bc in get_instructions(frame.f_code) }
-        self.frame=frame
+    def __init__(self, code: CodeType, lineno: int, stmts: Set[EnhancedAST], tree: ast.Module, lasti: int, source: Source):
+        self.code = code
+        self.info = code_info(code)
 
         self.source = source
         self.decorator: Optional[EnhancedAST] = None
 
         # work around for https://github.com/python/cpython/issues/96970
-        while self.opname(lasti) == "CACHE":
+        while lasti > 0 and self.opname(lasti) == "CACHE":
             lasti -= 2
 
-        try:
-            # try to map with all match_positions
-            self.result = self.find_node(lasti)
-        except NotOneValueFound:
-            typ: tuple[Type]
+        # try to map with all positions
+        nodes = self.find_nodes(lasti)
+        if len(nodes) != 1:
+            typ: tuple[Type, ...]
             # LOAD_METHOD could load "".join for long "..."%(...) BinOps
             # this can only be associated by using all positions
             if self.opname(lasti) in (
@@ -106,13 +165,12 @@ class PositionNodeFinder(object):
                 # One closing ) only belongs to one method.
                 typ = (ast.Call,)
             else:
-                raise
+                typ = ()
 
-            self.result = self.find_node(
-                lasti,
-                match_positions=("end_col_offset", "end_lineno"),
-                typ=typ,
-            )
+            if typ:
+                nodes = self.find_nodes(lasti, by_end=True, typ=typ)
+
+        self.result = only(nodes)
 
         instruction = self.instruction(lasti)
         assert instruction is not None
@@ -177,7 +235,7 @@ class PositionNodeFinder(object):
                     index += 4
 
     def fix_result(
-        self, node: EnhancedAST, instruction: dis.Instruction
+        self, node: EnhancedAST, instruction: Instruction
     ) -> EnhancedAST:
         if (
             sys.version_info >= (3, 12, 5)
@@ -279,7 +337,7 @@ class PositionNodeFinder(object):
 
         return node
 
-    def known_issues(self, node: EnhancedAST, instruction: dis.Instruction) -> None:
+    def known_issues(self, node: EnhancedAST, instruction: Instruction) -> None:
         if instruction.opname in ("COMPARE_OP", "IS_OP", "CONTAINS_OP") and isinstance(
             node, types_cmp_issue
         ):
@@ -425,20 +483,20 @@ class PositionNodeFinder(object):
 
             if header_length := self.annotation_header_size():
 
-                last_offset=list(self.bc_dict.keys())[-1]
+                last_offset=self.info.instruction_offsets[-1]
                 if (
                     not (header_length*2 < instruction.offset <last_offset-4)
                 ):
                     # https://github.com/python/cpython/issues/135700
                     raise KnownIssue("synthetic opcodes in annotations are just bound to the first node")
 
-                if self.frame.f_code.co_name=="__annotate__" and instruction.opname=="STORE_SUBSCR":
+                if self.code.co_name=="__annotate__" and instruction.opname=="STORE_SUBSCR":
                     raise KnownIssue("synthetic code to store annotation")
 
-                if self.frame.f_code.co_name=="__annotate__" and isinstance(node,ast.AnnAssign):
+                if self.code.co_name=="__annotate__" and isinstance(node,ast.AnnAssign):
                     raise KnownIssue("some opcodes in the annotation are just bound specific nodes")
 
-            if isinstance(node,(ast.TypeAlias)) and  self.frame.f_code.co_name==node.name.id :
+            if isinstance(node,(ast.TypeAlias)) and  self.code.co_name==node.name.id :
                 raise KnownIssue("some opcodes in the annotation are just bound TypeAlias")
 
             if instruction.opname == "STORE_NAME" and instruction.argrepr == "__annotate__":
@@ -451,7 +509,7 @@ class PositionNodeFinder(object):
 
     def annotation_header_size(self)->int:
         if sys.version_info >=(3,14):
-            header=[inst.opname for inst in itertools.islice(self.bc_dict.values(),8)]
+            header=self.info.opnames[:8]
 
             if len(header)==8:
                 if header[0] in ("COPY_FREE_VARS","MAKE_CELL"):
@@ -475,7 +533,7 @@ class PositionNodeFinder(object):
         return 0
 
     @staticmethod
-    def is_except_cleanup(inst: dis.Instruction, node: EnhancedAST) -> bool:
+    def is_except_cleanup(inst: Instruction, node: EnhancedAST) -> bool:
         if inst.opname not in (
             "STORE_NAME",
             "STORE_FAST",
@@ -530,7 +588,7 @@ class PositionNodeFinder(object):
             for n in parents(node)
         )
 
-    def verify(self, node: EnhancedAST, instruction: dis.Instruction) -> None:
+    def verify(self, node: EnhancedAST, instruction: Instruction) -> None:
         """
         checks if this node could gererate this instruction
         """
@@ -990,33 +1048,43 @@ class PositionNodeFinder(object):
 
         raise VerifierFailure(title, node, instruction)
 
-    def instruction(self, index: int) -> Optional[dis.Instruction]:
-        return self.bc_dict.get(index,None)
+    def instruction(self, index: int) -> Optional[Instruction]:
+        info = self.info
+        i = info.offsets.get(index)
+        if i is None:
+            return None
+        inst = info.decoded.get(index)
+        if inst is None:
+            if len(info.decoded) * 8 < len(info.instruction_offsets):
+                inst = info.decoded[index] = decode_instruction(self.code, info, i)
+            else:
+                # Cheaper than more single instructions once a good part is needed
+                decode_all_instructions(self.code, info)
+                inst = info.decoded[index]
+        return inst
 
     def instruction_before(
-        self, instruction: dis.Instruction
-    ) -> Optional[dis.Instruction]:
-        return self.bc_dict.get(instruction.offset - 2, None)
+        self, instruction: Instruction
+    ) -> Optional[Instruction]:
+        return self.instruction(instruction.offset - 2)
 
     def opname(self, index: int) -> str:
-        i=self.instruction(index)
+        i = self.info.offsets.get(index)
         if i is None:
             return "CACHE"
-        return i.opname
+        return self.info.opnames[i]
 
     extra_node_types: Tuple[Type[Any], ...] = ()
     if sys.version_info >= (3,12):
         extra_node_types = (ast.type_param,)
 
-    def find_node(
+    def find_node(self, index: int) -> EnhancedAST:
+        return only(self.find_nodes(index))
+
+    def find_nodes(
         self,
         index: int,
-        match_positions: Sequence[str] = (
-            "lineno",
-            "end_lineno",
-            "col_offset",
-            "end_col_offset",
-        ),
+        by_end: bool = False,
         typ: tuple[Type, ...] = (
             ast.expr,
             ast.stmt,
@@ -1024,22 +1092,30 @@ class PositionNodeFinder(object):
             ast.pattern,
             *extra_node_types,
         ),
-    ) -> EnhancedAST:
-        instruction = self.instruction(index)
-        assert instruction is not None
-
-        position = instruction.positions
-        assert position is not None and position.lineno is not None
+    ) -> list[EnhancedAST]:
+        """
+        Returns the nodes with the same positions as the instruction at `index`,
+        or if `by_end` is true, just the same end position.
+        """
+        assert index in self.info.offsets
+        position = dis.Positions(*self.info.positions[index // 2])
+        assert position.lineno is not None
+
+        index_ = self.source._nodes_by_line
+        if by_end:
+            nodes = index_.nodes_ending_at(
+                position.lineno, position.end_lineno, position.end_col_offset
+            )
+        else:
+            nodes = index_.nodes_at(
+                position.lineno, position.col_offset, position.end_lineno, position.end_col_offset
+            )
 
-        return only(
-            cast(EnhancedAST, node)
-            for node in self.source._nodes_by_line[position.lineno]
+        return [
+            node
+            for node in nodes
             if isinstance(node, typ)
             if not isinstance(node, ast.Expr)
             # matchvalue.value has the same positions as matchvalue themself, so we exclude ast.MatchValue
             if not isinstance(node, ast.MatchValue)
-            if all(
-                getattr(position, attr) == getattr(node, attr)
-                for attr in match_positions
-            )
-        )
+        ]
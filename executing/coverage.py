@@ -0,0 +1,174 @@
+"""
+Expression-level coverage: which expression nodes were executed, not just which lines.
+
+Collecting only records the offsets of executed instructions per code object.
+They're mapped to nodes in one batch per code object at the end by `expression_coverage`,
+so the overhead while running stays close to line coverage.
+`ExpressionCoverage` collects them with `sys.monitoring` on Python 3.12+:
+
+    from executing.coverage import ExpressionCoverage
+
+    with ExpressionCoverage() as coverage:
+        ...
+
+    for filename, file_coverage in coverage.report().items():
+        for node in file_coverage.uncovered:
+            print(filename, node.lineno, node.col_offset, type(node).__name__)
+"""
+
+import ast
+import sys
+import types
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Type
+
+from .executing import Source
+
+
+class FileCoverage(NamedTuple):
+    """
+    The expression nodes of one file which were and weren't executed,
+    sorted by position. They belong to `source.tree`.
+    """
+
+    source: Source
+    covered: List[ast.expr]
+    uncovered: List[ast.expr]
+
+
+def expression_coverage(
+    executed: Iterable[Tuple[types.CodeType, Iterable[int]]],
+    source_class: Type[Source] = Source,
+) -> Dict[str, FileCoverage]:
+    """
+    Maps the executed instruction offsets of each code object to expression nodes,
+    and returns the coverage of each file containing any of the code objects.
+    `executed` holds `(code, offsets)` pairs rather than being a dict keyed by code,
+    since code objects compare equal to identical code from other files.
+
+    The nodes that could have been covered are those that `executing` finds for any
+    instruction of the code compiled from the whole file, so code that never ran counts too.
+    """
+    by_filename: Dict[str, List[Tuple[types.CodeType, Iterable[int]]]] = {}
+    for code, offsets in executed:
+        by_filename.setdefault(code.co_filename, []).append((code, offsets))
+
+    result = {}
+    for filename, codes_offsets in by_filename.items():
+        source = source_class.for_filename(filename)
+        if not source.tree:
+            continue
+
+        covered: Set[ast.expr] = set()
+        for code, offsets in codes_offsets:
+            mapping = source_class.executing_map(code)
+            for offset in offsets:
+                node = mapping.get(offset, (None, None))[0]
+                if isinstance(node, ast.expr):
+                    covered.add(node)
+
+        possible = set(covered)
+        try:
+            codes = [compile(source.text, filename, "exec", dont_inherit=True)]
+        except (SyntaxError, ValueError):
+            codes = []
+        for code in codes:
+            codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+            for node, _ in source_class.executing_map(code).values():
+                if isinstance(node, ast.expr):
+                    possible.add(node)
+
+        result[filename] = FileCoverage(
+            source,
+            sorted(covered, key=node_position),
+            sorted(possible - covered, key=node_position),
+        )
+
+    return result
+
+
+def node_position(node: ast.expr) -> Tuple[int, int, int, int]:
+    return (
+        node.lineno,
+        node.col_offset,
+        node.end_lineno or node.lineno,
+        node.end_col_offset or node.col_offset,
+    )
+
+
+if sys.version_info >= (3, 12):
+    from .monitoring import monitoring, use_free_tool_id
+
+    class ExpressionCoverage(object):
+        """
+        Records the executed instructions of all code while started,
+        using `sys.monitoring` INSTRUCTION events (Python 3.12+) with a free tool id
+        as in `executing.monitoring.NodeMonitor`. Each event returns DISABLE,
+        so every instruction only generates an event the first time it runs.
+        Starting calls `sys.monitoring.restart_events()`, which affects other tools too.
+
+        `report()` passes the recorded offsets to `expression_coverage`.
+        """
+
+        def __init__(
+            self,
+            source_class: Type[Source] = Source,
+            tool_id: Optional[int] = None,
+            name: str = "executing coverage",
+        ) -> None:
+            self.source_class = source_class
+            self.tool_id = tool_id
+            self.name = name
+            self.active_tool_id: Optional[int] = None
+            # Keyed by id, since code objects compare (and hash) by value
+            self.codes: Dict[int, Tuple[types.CodeType, Set[int]]] = {}
+
+        def start(self) -> None:
+            if self.active_tool_id is not None:
+                raise RuntimeError("ExpressionCoverage is already started")
+
+            tool_id = use_free_tool_id(self.tool_id, self.name)
+            events = monitoring.events.INSTRUCTION
+            monitoring.register_callback(tool_id, events, self._handler())
+            # Locations disabled in an earlier run generate events again
+            monitoring.restart_events()
+            monitoring.set_events(tool_id, events)
+            self.active_tool_id = tool_id
+
+        def stop(self) -> None:
+            tool_id = self.active_tool_id
+            if tool_id is None:
+                return
+            monitoring.set_events(tool_id, monitoring.events.NO_EVENTS)
+            monitoring.register_callback(tool_id, monitoring.events.INSTRUCTION, None)
+            monitoring.free_tool_id(tool_id)
+            self.active_tool_id = None
+
+        def __enter__(self) -> "ExpressionCoverage":
+            self.start()
+            return self
+
+        def __exit__(self, *_: Any) -> None:
+            self.stop()
+
+        def _handler(self) -> Any:
+            codes = self.codes
+            disable = monitoring.DISABLE
+
+            def handle(code: types.CodeType, offset: int) -> Any:
+                entry = codes.get(id(code))
+                if entry is None:
+                    entry = codes[id(code)] = (code, set())
+                entry[1].add(offset)
+                return disable
+
+            return handle
+
+        def executed(self) -> List[Tuple[types.CodeType, Set[int]]]:
+            """
+            Returns `(code, offsets)` pairs of the instructions executed so far
+            in each code object, in the form that `expression_coverage` takes.
+            """
+            return [(code, set(offsets)) for code, offsets in list(self.codes.values())]
+
+        def report(self) -> Dict[str, FileCoverage]:
+            return expression_coverage(self.executed(), self.source_class)
@@ -31,17 +31,22 @@ import linecache
 import re
 import sys
 import types
-from collections import defaultdict
-from copy import deepcopy
-from functools import lru_cache
+import weakref
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from copy import copy, deepcopy
+from functools import lru_cache, partial
 from itertools import islice
 from itertools import zip_longest
 from operator import attrgetter
 from pathlib import Path
-from threading import RLock
+from threading import Event, Lock, RLock
+from time import monotonic
 from tokenize import detect_encoding
 from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Sized, Tuple, Type, TypeVar, Union, cast
 from ._utils import mangled_name,assert_, EnhancedAST,EnhancedInstruction,Instruction,get_instructions
+from . import _disk_cache
 
 
 if TYPE_CHECKING:
@@ -53,6 +58,9 @@ function_node_types: Tuple[Type, ...] = (ast.FunctionDef, ast.AsyncFunctionDef)
 
 cache = lru_cache(maxsize=None)
 
+# Guards the creation of the caches of each Source class
+class_caches_lock = Lock()
+
 TESTING = 0
 
 class NotOneValueFound(Exception):
@@ -66,7 +74,7 @@ T = TypeVar('T')
 def only(it: Iterable[T]) -> T:
     if isinstance(it, Sized):
         if len(it) != 1:
-            raise NotOneValueFound('Expected one value, found %s' % len(it))
+            raise NotOneValueFound('Expected one value, found %s' % len(it), tuple(it))
         # noinspection PyTypeChecker
         return list(it)[0]
 
@@ -95,13 +103,48 @@ class Source(object):
         - lines
         - tree: AST parsed from text, or None if text is not valid Python
             All nodes in the tree have an extra `parent` attribute
+            (these are added lazily, the first time `tree` is accessed),
+            except nodes like `ast.Load()` which may be shared between trees
 
     Other methods of interest:
         - statements_at_line
+        - get_text
         - asttokens
         - code_qualname
+
+    The cache of instances can be bounded by setting the class attributes
+    `max_cached_sources` and/or `max_cached_bytes` (an estimate of the memory
+    used by each instance, see `estimated_size`). The least recently used
+    instances are evicted first, along with any cached `executing` results
+    that refer to them, and are transparently rebuilt when needed again.
+    See also `clear_cache` and `invalidate`.
+
+    Cached `executing` results only hold weak references to code objects,
+    so they're discarded when the code object is garbage collected
+    (e.g. functions created with `exec`). The class attribute `max_cached_codes`
+    additionally bounds the number of code objects with cached results,
+    again evicting the least recently used first.
+
+    Looking up an instance by filename checks whether the file has changed
+    with `linecache.checkcache`, which stats the file. The class attribute
+    `linecache_check_interval` is the minimum number of seconds between checks
+    of the same file. The default of 0 checks every time, None never checks
+    (e.g. when deployed files never change). `revalidate` checks all cached files at once.
+
+    Setting the class attribute `disk_cache_dir` to a directory saves the index
+    of nodes and qualnames computed for each source there, so that other processes
+    (e.g. freshly started workers) can load it instead of computing it again.
+    Files are keyed by a hash of the text and the Python version and written atomically,
+    so the directory can be shared by concurrent processes and never needs clearing
+    except to reclaim space.
     """
 
+    max_cached_sources: Optional[int] = None
+    max_cached_bytes: Optional[int] = None
+    max_cached_codes: Optional[int] = None
+    linecache_check_interval: Optional[float] = 0
+    disk_cache_dir: Optional[Union[str, Path]] = None
+
     def __init__(self, filename: str, lines: Sequence[str]) -> None:
         """
         Don't call this constructor, see the class docstring.
@@ -111,26 +154,51 @@ class Source(object):
         self.text = ''.join(lines)
         self.lines = [line.rstrip('\r\n') for line in lines]
 
-        self._nodes_by_line = defaultdict(list)
-        self.tree = None
-        self._qualnames = {}
-        self._asttokens: Optional[ASTTokens] = None
-        self._asttext: Optional[ASTText] = None
+        self._tree: Optional[ast.Module] = None
+        # Offset in self.text of the start of each line, see get_text_range
+        self._line_offsets: Optional["array[int]"] = None
 
         try:
-            self.tree = ast.parse(self.text, filename=filename)
+            self._tree = ast.parse(self.text, filename=filename)
         except (SyntaxError, ValueError):
             pass
-        else:
-            for node in ast.walk(self.tree):
-                for child in ast.iter_child_nodes(node):
-                    cast(EnhancedAST, child).parent = cast(EnhancedAST, node)
-                for lineno in node_linenos(node):
-                    self._nodes_by_line[lineno].append(node)
 
-            visitor = QualnameVisitor()
-            visitor.visit(self.tree)
-            self._qualnames = visitor.qualnames
+        self._index_tree()
+
+        if self._tree is not None and self.disk_cache_dir is not None:
+            directory = str(self.disk_cache_dir)
+            data = _disk_cache.load(directory, self.text)
+            if data is None or not self._nodes_by_line.load(data):
+                # Index everything once so that later processes don't need to
+                self._nodes_by_line.index_all()
+                _disk_cache.save(directory, self.text, self._nodes_by_line.dump())
+
+    def _index_tree(self) -> None:
+        """
+        Resets everything derived from `_tree`, which is then computed lazily.
+        """
+        self._statements_at_line: Dict[int, Set[EnhancedAST]] = {}
+        self._asttokens: Optional[ASTTokens] = None
+        self._asttext: Optional[ASTText] = None
+        # Parent links, nodes by line and qualnames are only computed
+        # for the top-level statements covering the lines that are looked up.
+        self._nodes_by_line = ModuleIndex(self._tree)
+        # Used by SentinelNodeFinder, see sentinel_table
+        self._sentinel_tables: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._qualnames = self._nodes_by_line.qualnames
+
+    @property
+    def tree(self) -> Optional[ast.Module]:
+        if self._tree is not None:
+            self._nodes_by_line.index_all()
+        return self._tree
+
+    @tree.setter
+    def tree(self, tree: Optional[ast.Module]) -> None:
+        # The index is rebuilt lazily for the new tree.
+        # Cached `executing` results for the old tree are kept.
+        self._tree = tree
+        self._index_tree()
 
     @classmethod
     def for_frame(cls, frame: types.FrameType, use_cache: bool = True) -> Source:
@@ -149,33 +217,107 @@ class Source(object):
         if isinstance(filename, Path):
             filename = str(filename)
 
-        def get_lines() -> List[str]:
-            return linecache.getlines(filename, module_globals)
+        source_cache = cls._source_cache()
+        if source_cache.should_check(filename, cls.linecache_check_interval):
+            lines = checkcache_and_getlines(filename, module_globals)
+        else:
+            lines = linecache.getlines(filename, module_globals)
+
+        # Fast path: `lines` is the same list object as long as the linecache entry
+        # hasn't been replaced, so there's no need to hash and compare its contents.
+        result = source_cache.get_by_linecache_lines(filename, lines)
+        if result is None:
+            result = cls._for_filename_and_lines(filename, tuple(lines))
+            source_cache.set_linecache_lines(filename, lines, result)
+        return result
 
-        # Save the current linecache entry, then ensure the cache is up to date.
-        entry = linecache.cache.get(filename) # type: ignore[attr-defined]
-        linecache.checkcache(filename)
-        lines = get_lines()
-        if entry is not None and not lines:
-            # There was an entry, checkcache removed it, and nothing replaced it.
-            # This means the file wasn't simply changed (because the `lines` wouldn't be empty)
-            # but rather the file was found not to exist, probably because `filename` was fake.
-            # Restore the original entry so that we still have something.
-            linecache.cache[filename] = entry # type: ignore[attr-defined]
-            lines = get_lines()
+    @classmethod
+    def _for_filename_and_lines(cls, filename: str, lines: Sequence[str]) -> Source:
+        source_cache = cls._source_cache()
+        key = (filename, lines)
+        result = source_cache.get(key)
+        if result is None:
+            # Threads needing the same source at the same time wait for one of them to build it
+            result = source_cache.in_flight.run(key, lambda: cls._build(key))
+        return result
 
-        return cls._for_filename_and_lines(filename, tuple(lines))
+    @classmethod
+    def _build(cls, key: Tuple[str, Sequence[str]]) -> Source:
+        source_cache = cls._source_cache()
+        result = source_cache.get(key)
+        if result is None:
+            result = cls(*key)
+            evicted = source_cache.add(key, result, cls.max_cached_sources, cls.max_cached_bytes)
+            cls._forget_executing(evicted)
+        return result
 
     @classmethod
-    def _for_filename_and_lines(cls, filename: str, lines: Sequence[str]) -> Source:
-        source_cache: Dict[Tuple[str, Sequence[str]], Source] = cls._class_local('__source_cache_with_lines', {})
+    def _source_cache(cls) -> _SourceCache:
         try:
-            return source_cache[(filename, lines)]
+            return cls.__dict__['__source_cache']
         except KeyError:
-            pass
+            # Make sure concurrent first calls share the same instance
+            with class_caches_lock:
+                return cls._class_local('__source_cache', _SourceCache())
 
-        result = source_cache[(filename, lines)] = cls(filename, lines)
-        return result
+    @classmethod
+    def _executing_cache(cls) -> _ExecutingCache:
+        try:
+            return cls.__dict__['__executing_cache']
+        except KeyError:
+            source_cache = cls._source_cache()
+            # Make sure concurrent first calls share the same instance
+            with class_caches_lock:
+                return cls._class_local('__executing_cache', _ExecutingCache(source_cache))
+
+    @classmethod
+    def _forget_executing(cls, sources: List[Source]) -> None:
+        """
+        Removes cached `executing` results which refer to any of the given sources.
+        """
+        executing_cache = cls.__dict__.get('__executing_cache')
+        if sources and executing_cache:
+            executing_cache.forget(sources)
+
+    @classmethod
+    def revalidate(cls) -> None:
+        """
+        Checks all the files of cached instances for changes in one go,
+        regardless of `linecache_check_interval`.
+        Changed files get new instances the next time they're looked up.
+        """
+        source_cache = cls._source_cache()
+        for filename in source_cache.filenames():
+            checkcache_and_getlines(filename, None)
+            source_cache.mark_checked(filename)
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        """
+        Removes all cached `Source` instances and `executing` results for this class.
+        """
+        cls._source_cache().clear()
+        cls._executing_cache().clear()
+
+    @classmethod
+    def invalidate(cls, filename: Union[str, Path]) -> None:
+        """
+        Removes the cached `Source` instances for the given filename,
+        along with the cached `executing` results that refer to them.
+        They will be rebuilt the next time they're needed.
+        """
+        filename = str(filename)
+        cls._forget_executing(cls._source_cache().remove(filename))
+
+    def estimated_size(self) -> int:
+        """
+        Returns a rough estimate of the memory in bytes used by this instance,
+        including the AST and the indexes built from it.
+        Used to enforce `max_cached_bytes`.
+        """
+        # Measured on a variety of real files, the tree and indexes
+        # take about 40-60 bytes per character of source code.
+        return len(self.text) * 50
 
     @classmethod
     def lazycache(cls, frame: types.FrameType) -> None:
@@ -188,55 +330,211 @@ class Source(object):
         currently executing in the given frame or traceback object.
         """
         if isinstance(frame_or_tb, types.TracebackType):
-            # https://docs.python.org/3/reference/datamodel.html#traceback-objects
-            # "tb_lineno gives the line number where the exception occurred;
-            #  tb_lasti indicates the precise instruction.
-            #  The line number and last instruction in the traceback may differ
-            #  from the line number of its frame object
-            #  if the exception occurred in a try statement with no matching except clause
-            #  or with a finally clause."
-            tb = frame_or_tb
-            frame = tb.tb_frame
-            lineno = tb.tb_lineno
-            lasti = tb.tb_lasti
+            frame, lasti = frame_or_tb.tb_frame, frame_or_tb.tb_lasti
         else:
-            frame = frame_or_tb
-            lineno = frame.f_lineno
-            lasti = frame.f_lasti
+            frame, lasti = frame_or_tb, frame_or_tb.f_lasti
+        code = frame.f_code
 
+        # Fast path for results that are already cached, which is most calls:
+        # just dict lookups, without method calls or the line number
+        # (which has to be computed from the line table in 3.11+).
+        executing_cache = cls.__dict__.get('__executing_cache')
+        if executing_cache is not None and cls.max_cached_codes is None:
+            entry = executing_cache.codes.get(id(code))
+            if entry is not None:
+                info = entry[1].get(lasti)
+                if info:
+                    return Executing.from_info(frame, info)
+
+        offsets = cls._executing_cache().offsets(code, cls.max_cached_codes)
+        info = offsets.get(lasti)
+        if not info:
+            lineno = frame_position(frame_or_tb)[1]
+            info = cls._executing_cache().find(
+                code, offsets, lasti,
+                lambda: cls.for_frame(frame)._find_node(code, lineno, lasti),
+            )
 
+        return Executing.from_info(frame, info)
 
-        code = frame.f_code
-        key = (code, id(code), lasti)
-        executing_cache: Dict[Tuple[types.CodeType, int, int], Any] = cls._class_local('__executing_cache', {})
-
-        args = executing_cache.get(key)
-        if not args:
-            node = stmts = decorator = None
-            source = cls.for_frame(frame)
-            tree = source.tree
-            if tree:
-                try:
-                    stmts = source.statements_at_line(lineno)
-                    if stmts:
-                        if is_ipython_cell_code(code):
-                            decorator, node = find_node_ipython(frame, lasti, stmts, source)
-                        else:
-                            node_finder = NodeFinder(frame, stmts, tree, lasti, source)
-                            node = node_finder.result
-                            decorator = node_finder.decorator
-
-                    if node:
-                        new_stmts = {statement_containing_node(node)}
-                        assert_(new_stmts <= stmts)
-                        stmts = new_stmts
-                except Exception:
-                    if TESTING:
-                        raise
+    @classmethod
+    def executing_at(
+        cls,
+        code: types.CodeType,
+        lasti: int,
+        lineno: Optional[int] = None,
+        module_globals: Optional[Dict[str, Any]] = None,
+    ) -> ExecutingInfo:
+        """
+        Returns the `ExecutingInfo` for the instruction at offset `lasti` of `code`,
+        i.e. what `executing(frame).info` would be for a frame with
+        `f_code = code`, `f_lasti = lasti` and `f_globals = module_globals`.
+        It uses the same cache, so each position is only resolved once.
+
+        This is for callers which don't have a frame, such as sampling profilers
+        and `sys.monitoring` callbacks. `lineno` is the current line as in `frame.f_lineno`
+        and is computed from `code` if it's not given.
+        Raises ValueError if `lasti` isn't the offset of an instruction in `code`.
+        """
+        executing_cache = cls._executing_cache()
+        offsets = executing_cache.offsets(code, cls.max_cached_codes)
+        info = offsets.get(lasti)
+        if not info:
+            if lasti % 2 or not 0 <= lasti < len(code.co_code):
+                raise ValueError("Invalid offset %r for %r" % (lasti, code))
+            if lineno is None:
+                lineno = offset_lineno(code, lasti)
+            source = cls.for_filename(code.co_filename, module_globals)
+            info = executing_cache.find(
+                code, offsets, lasti,
+                partial(source._find_node, code, lineno, lasti),
+            )
+        return info
+
+    @classmethod
+    def executing_many(
+        cls,
+        frames_or_tbs: Union[types.TracebackType, Iterable[Union[types.TracebackType, types.FrameType]]],
+    ) -> List[Executing]:
+        """
+        Returns the `Executing` objects for several frames or traceback objects, in the same order.
+        A single traceback object is followed through `tb_next` to get the whole traceback.
+
+        This is equivalent to calling `executing` for each one,
+        but each `Source` is only looked up once
+        and repeated positions (e.g. from recursion) are only resolved once,
+        so rendering a large stack costs roughly the number of distinct positions in it.
+        """
+        if isinstance(frames_or_tbs, types.TracebackType):
+            tbs = []
+            tb: Optional[types.TracebackType] = frames_or_tbs
+            while tb is not None:
+                tbs.append(tb)
+                tb = tb.tb_next
+            frames_or_tbs = tbs
+
+        executing_cache = cls._executing_cache()
+        sources: Dict[str, Source] = {}
+        result = []
+        for frame_or_tb in frames_or_tbs:
+            if isinstance(frame_or_tb, types.TracebackType):
+                frame, lasti = frame_or_tb.tb_frame, frame_or_tb.tb_lasti
+            else:
+                frame, lasti = frame_or_tb, frame_or_tb.f_lasti
+            code = frame.f_code
+            offsets = executing_cache.offsets(code, cls.max_cached_codes)
+            info = offsets.get(lasti)
+            if not info:
+                lineno = frame_position(frame_or_tb)[1]
+                source = sources.get(code.co_filename)
+                if source is None:
+                    source = sources[code.co_filename] = cls.for_frame(frame)
+                info = executing_cache.find(
+                    code, offsets, lasti,
+                    partial(source._find_node, code, lineno, lasti),
+                )
+            result.append(Executing.from_info(frame, info))
+        return result
+
+    @classmethod
+    def executing_map(
+        cls,
+        code: types.CodeType,
+        module_globals: Optional[Dict[str, Any]] = None,
+    ) -> Dict[int, Tuple[Optional[ast.AST], Optional[EnhancedAST]]]:
+        """
+        Returns a dict mapping the offset of every instruction in `code`
+        to the `(node, decorator)` pair that `executing` would give
+        for a frame or traceback at that offset.
+
+        This is much cheaper than calling `executing` for each offset separately,
+        and the results are also cached for later calls to `executing`.
+        Tools such as tracers and coverage collectors which look at
+        most instructions of a code object should use this.
+        """
+        return {
+            lasti: (info.node, info.decorator)
+            for lasti, info in cls._executing_all(code, module_globals)
+        }
+
+    @classmethod
+    def executing_table(
+        cls,
+        code: types.CodeType,
+        module_globals: Optional[Dict[str, Any]] = None,
+    ) -> List[Optional[ExecutingInfo]]:
+        """
+        Returns a list where `table[frame.f_lasti]` is the `ExecutingInfo`
+        that `executing(frame).info` would give for any frame executing `code`.
 
-            executing_cache[key] = args = source, node, stmts, decorator
+        This is for tracers which look up every event, especially with `frame.f_trace_opcodes`:
+        get the table once per code object, e.g. in the 'call' event, and each event
+        then only costs a list index. Indexes that aren't the offset of an instruction
+        hold None, including the last one, so an `f_lasti` of -1
+        (before the first instruction) also gives None.
 
-        return Executing(frame, *args)
+        The table is built with `executing_map` and cached along with the other results for `code`.
+        """
+        executing_cache = cls._executing_cache()
+        table = executing_cache.tables.get(id(code))
+        if table is None:
+            table = [None] * (len(code.co_code) + 1)
+            for lasti, info in cls._executing_all(code, module_globals):
+                table[lasti] = info
+            executing_cache.add_table(code, table)
+        return table
+
+    @classmethod
+    def _executing_all(
+        cls,
+        code: types.CodeType,
+        module_globals: Optional[Dict[str, Any]],
+    ) -> List[Tuple[int, ExecutingInfo]]:
+        """
+        Returns the offset and `ExecutingInfo` of every instruction in `code`.
+        """
+        executing_cache = cls._executing_cache()
+        offsets = executing_cache.offsets(code, cls.max_cached_codes)
+        source = cls.for_filename(code.co_filename, module_globals)
+        result = []
+        for lasti, lineno in code_offset_linenos(code):
+            info = offsets.get(lasti)
+            if not info:
+                info = executing_cache.find(
+                    code, offsets, lasti,
+                    partial(source._find_node, code, lineno, lasti),
+                )
+            result.append((lasti, info))
+        return result
+
+    def _find_node(self, code: types.CodeType, lineno: Optional[int], lasti: int) -> ExecutingInfo:
+        """
+        Returns the `ExecutingInfo` for the instruction at offset `lasti` of `code`,
+        where `lineno` is the current line as in `frame.f_lineno`.
+        """
+        node = stmts = decorator = None
+        tree = self._tree
+        if tree and lineno is not None:
+            try:
+                stmts = self.statements_at_line(lineno)
+                if stmts:
+                    if code_info(code).is_ipython_cell:
+                        decorator, node = find_node_ipython(code, lineno, lasti, stmts, self)
+                    else:
+                        node_finder = NodeFinder(code, lineno, stmts, tree, lasti, self)
+                        node = node_finder.result
+                        decorator = node_finder.decorator
+
+                if node:
+                    new_stmts = {self._nodes_by_line.statement_containing(node)}
+                    assert_(new_stmts <= stmts)
+                    stmts = new_stmts
+            except Exception:
+                if TESTING:
+                    raise
+
+        # node and stmts are None if nothing was found
+        return ExecutingInfo(self, cast(EnhancedAST, node), cast(Set[ast.stmt], stmts), decorator, code)
 
     @classmethod
     def _class_local(cls, name: str, default: T) -> T:
@@ -249,7 +547,6 @@ class Source(object):
         setattr(cls, name, result)
         return result
 
-    @cache
     def statements_at_line(self, lineno: int) -> Set[EnhancedAST]:
         """
         Returns the statement nodes overlapping the given line.
@@ -263,11 +560,17 @@ class Source(object):
         should return at least one statement.
         """
 
-        return {
-            statement_containing_node(node)
-            for node in
-            self._nodes_by_line[lineno]
+        try:
+            return self._statements_at_line[lineno]
+        except KeyError:
+            pass
+
+        index = self._nodes_by_line
+        result = self._statements_at_line[lineno] = {
+            index.statement_containing(node)
+            for node in index[lineno]
         }
+        return result
 
     def asttext(self) -> ASTText:
         """
@@ -305,6 +608,93 @@ class Source(object):
         else:  # pragma: no cover
             return self.asttokens()
 
+    def get_text_range(self, node: Optional[ast.AST]) -> Tuple[int, int]:
+        """
+        Returns the start and end offsets in `self.text` of the source code of `node`,
+        the same as `self.asttext().get_text_range(node)`.
+        Returns `(0, 0)` for None and nodes with no position, such as `ast.Load`.
+
+        This only uses the positions of the node and the lines they're on,
+        so it doesn't need asttokens or the rest of the file, except for the few
+        node types that asttokens also can't handle without tokenizing the file.
+        """
+        if node is None:
+            return 0, 0
+        if isinstance(node, ast.Module):
+            return 0, len(self.text)
+        if PYPY or type(node).__name__ in tokens_needed_types:
+            return self._asttext_base().get_text_range(node)
+        if getattr(node, 'lineno', None) is None:
+            return 0, 0
+        if sys.version_info < (3, 12) and self._fstring_position_broken(node):
+            return 0, 0
+
+        # Decorated definitions start at the first decorator
+        decorators = getattr(node, 'decorator_list', None)
+        start_node: Any = decorators[0] if decorators else node
+        # Exclude trailing semicolons and comments after the body of compound statements
+        end_node = last_statement(node)
+        start_lineno = start_node.lineno
+        if start_lineno != end_node.lineno:
+            # Include the indentation of compound statements so that they can be dedented
+            start = self._text_offset(start_lineno, 0)
+        else:
+            start = self._text_offset(start_lineno, start_node.col_offset)
+        end = self._text_offset(end_node.end_lineno, end_node.end_col_offset)
+        return start, end
+
+    def get_text(self, node: Optional[ast.AST]) -> str:
+        """
+        Returns the source code of `node`, see `get_text_range`.
+        """
+        start, end = self.get_text_range(node)
+        return self.text[start:end]
+
+    def _fstring_position_broken(self, node: ast.AST) -> bool:
+        """
+        Before Python 3.12, the positions of the parts of f-strings span the whole f-string,
+        and in Python < 3.9.7 the positions of expressions inside them can be wrong.
+        Returns True for the same nodes as `asttokens.util.annotate_fstring_nodes`.
+        """
+        if not hasattr(node, 'parent'):
+            # Ensure the statement containing the node has parent links
+            self._nodes_by_line.index_line(cast(int, getattr(node, 'lineno')))
+        child = node
+        parent = getattr(node, 'parent', None)
+        while parent is not None and not isinstance(child, ast.stmt):
+            if isinstance(parent, ast.JoinedStr) and child is node:
+                return True
+            if isinstance(parent, ast.FormattedValue) and (
+                parent.format_spec is node
+                or sys.version_info < (3, 9, 7)
+            ):
+                return True
+            child = parent
+            parent = getattr(parent, 'parent', None)
+        return False
+
+    def _text_offset(self, lineno: int, col_offset: int) -> int:
+        """
+        Returns the offset in `self.text` of a position in the AST,
+        where `col_offset` counts UTF-8 bytes.
+        """
+        line_offsets = self._line_offsets
+        if line_offsets is None:
+            line_offsets = self._line_offsets = array('L', [0])
+            line_offsets.extend(match.end() for match in re.finditer('\n', self.text))
+
+        if lineno < 1:
+            return 0
+        if lineno > len(line_offsets):
+            return len(self.text)
+        start = line_offsets[lineno - 1]
+        end = line_offsets[lineno] if lineno < len(line_offsets) else len(self.text)
+        # Each character is at least one byte, so the column is within this prefix of the line
+        prefix = self.text[start:min(start + max(0, col_offset), end)]
+        if not prefix.isascii():
+            prefix = prefix.encode('utf8')[:col_offset].decode('utf8', 'ignore')
+        return start + len(prefix)
+
     @staticmethod
     def decode_source(source: Union[str, bytes]) -> str:
         if isinstance(source, bytes):
@@ -340,9 +730,414 @@ class Source(object):
         of both lambdas)
         """
         assert_(code.co_filename == self.filename)
+        if not self._nodes_by_line.all_qualnames:
+            self._nodes_by_line.index_line(code.co_firstlineno)
         return self._qualnames.get((code.co_name, code.co_firstlineno), code.co_name)
 
 
+def checkcache_and_getlines(filename: str, module_globals: Optional[Dict[str, Any]]) -> List[str]:
+    """
+    Ensures the linecache entry for `filename` is up to date and returns its lines.
+    """
+    def get_lines() -> List[str]:
+        return linecache.getlines(filename, module_globals)
+
+    # Save the current linecache entry, then ensure the cache is up to date.
+    entry = linecache.cache.get(filename) # type: ignore[attr-defined]
+    linecache.checkcache(filename)
+    lines = get_lines()
+    if entry is not None and not lines:
+        # There was an entry, checkcache removed it, and nothing replaced it.
+        # This means the file wasn't simply changed (because the `lines` wouldn't be empty)
+        # but rather the file was found not to exist, probably because `filename` was fake.
+        # Restore the original entry so that we still have something.
+        linecache.cache[filename] = entry # type: ignore[attr-defined]
+        lines = get_lines()
+    return lines
+
+
+class SingleFlight(object):
+    """
+    Deduplicates concurrent computations of the same key:
+    the first thread to `run` a key computes the value while other threads
+    running the same key in the meantime wait for it and get the same value.
+    If the computation raises an exception, the waiting threads compute the value themselves.
+    Nothing is cached once the computation is over.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.calls: Dict[Any, _Call] = {}
+
+    def run(self, key: Any, compute: Callable[[], T]) -> T:
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.succeeded:
+                return call.result
+            return compute()
+
+        try:
+            call.result = compute()
+            call.succeeded = True
+            return call.result
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+class _Call(object):
+    __slots__ = ("done", "result", "succeeded")
+
+    def __init__(self) -> None:
+        self.done = Event()
+        self.result: Any = None
+        self.succeeded = False
+
+
+class _SourceCache(object):
+    """
+    The cached `Source` instances of one `Source` class.
+
+    Sources are found by filename and lines, or more cheaply by filename and
+    the identity of the list of lines in `linecache`, which only changes
+    when the file is reloaded.
+    `recent` orders the sources from least to most recently used.
+    """
+
+    def __init__(self) -> None:
+        self.sources: Dict[Tuple[str, Sequence[str]], Source] = {}
+        self.recent: OrderedDict[int, Tuple[Tuple[str, Sequence[str]], Source]] = OrderedDict()
+        self.by_linecache_lines: Dict[str, Tuple[List[str], Source]] = {}
+        self.last_checked: Dict[str, float] = {}
+        self.total_size = 0
+        self.lock = RLock()
+        self.in_flight = SingleFlight()
+
+    def should_check(self, filename: str, interval: Optional[float]) -> bool:
+        """
+        Returns True if `filename` should be checked for changes now, i.e. if it
+        hasn't been checked in the last `interval` seconds, and if so records the check.
+        """
+        if interval is None:
+            return False
+        if not interval:
+            return True
+        now = monotonic()
+        last = self.last_checked.get(filename)
+        if last is not None and now - last < interval:
+            return False
+        self.last_checked[filename] = now
+        return True
+
+    def mark_checked(self, filename: str) -> None:
+        self.last_checked[filename] = monotonic()
+
+    def filenames(self) -> List[str]:
+        with self.lock:
+            return list({key[0] for key in self.sources})
+
+    def contains(self, source: Source) -> bool:
+        with self.lock:
+            entry = self.recent.get(id(source))
+            return entry is not None and entry[1] is source
+
+    def get(self, key: Tuple[str, Sequence[str]]) -> Optional[Source]:
+        with self.lock:
+            source = self.sources.get(key)
+            if source is not None:
+                self.recent.move_to_end(id(source))
+            return source
+
+    def get_by_linecache_lines(self, filename: str, lines: List[str]) -> Optional[Source]:
+        with self.lock:
+            entry = self.by_linecache_lines.get(filename)
+            if entry is None or entry[0] is not lines:
+                return None
+            source = entry[1]
+            self.recent.move_to_end(id(source))
+            return source
+
+    def set_linecache_lines(self, filename: str, lines: List[str], source: Source) -> None:
+        with self.lock:
+            # Don't resurrect a source that has been evicted already
+            if id(source) in self.recent:
+                # Keeping a reference to `lines` also ensures that its id isn't reused
+                self.by_linecache_lines[filename] = (lines, source)
+
+    def add(
+        self,
+        key: Tuple[str, Sequence[str]],
+        source: Source,
+        max_sources: Optional[int],
+        max_bytes: Optional[int],
+    ) -> List[Source]:
+        """
+        Stores `source` and returns the sources evicted to respect the limits.
+        The most recently added source is never evicted.
+        """
+        evicted = []
+        with self.lock:
+            old = self.sources.get(key)
+            if old is not None:
+                self.discard(key, old)
+                evicted.append(old)
+            self.sources[key] = source
+            self.recent[id(source)] = (key, source)
+            self.total_size += source.estimated_size()
+
+            while len(self.recent) > 1 and (
+                max_sources is not None and len(self.recent) > max_sources
+                or max_bytes is not None and self.total_size > max_bytes
+            ):
+                old_key, old = next(iter(self.recent.values()))
+                self.discard(old_key, old)
+                evicted.append(old)
+        return evicted
+
+    def discard(self, key: Tuple[str, Sequence[str]], source: Source) -> None:
+        with self.lock:
+            del self.sources[key]
+            del self.recent[id(source)]
+            self.total_size -= source.estimated_size()
+            entry = self.by_linecache_lines.get(key[0])
+            if entry is not None and entry[1] is source:
+                del self.by_linecache_lines[key[0]]
+                self.last_checked.pop(key[0], None)
+
+    def remove(self, filename: str) -> List[Source]:
+        """
+        Removes and returns all sources for the given filename.
+        """
+        with self.lock:
+            items = [(key, source) for key, source in self.sources.items() if key[0] == filename]
+            for key, source in items:
+                self.discard(key, source)
+        return [source for _, source in items]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.sources.clear()
+            self.recent.clear()
+            self.by_linecache_lines.clear()
+            self.last_checked.clear()
+            self.total_size = 0
+
+
+class _ExecutingCache(object):
+    """
+    The cached `executing` results of one `Source` class,
+    as a dict from offset to `ExecutingInfo` for each code object.
+
+    Code objects compare by value, so they're keyed by id.
+    They're only referenced weakly, and a weakref callback removes
+    their entry when they're garbage collected.
+    `codes` orders them from least to most recently used.
+    `tables` holds the lists from `Source.executing_table` for some of the same code objects.
+    `by_source` maps the id of each `Source` referred to by a result
+    to that source and the keys of the code objects with results referring to it,
+    so that `forget` only looks at those.
+    Results are only cached while their source is in `source_cache`.
+    """
+
+    def __init__(self, source_cache: _SourceCache) -> None:
+        self.source_cache = source_cache
+        self.codes: OrderedDict[int, Tuple[weakref.ref, Dict[int, ExecutingInfo]]] = OrderedDict()
+        self.tables: Dict[int, List[Optional[ExecutingInfo]]] = {}
+        self.by_source: Dict[int, Tuple[Source, Set[int]]] = {}
+        self.lock = RLock()
+        self.in_flight = SingleFlight()
+
+    def offsets(self, code: types.CodeType, max_codes: Optional[int]) -> Dict[int, ExecutingInfo]:
+        """
+        Returns the dict of cached results for `code`, adding an empty one if needed
+        and then evicting the least recently used code objects beyond `max_codes`.
+        """
+        key = id(code)
+        entry = self.codes.get(key)
+        if entry is not None:
+            if max_codes is not None:
+                try:
+                    self.codes.move_to_end(key)
+                except KeyError:
+                    pass
+            return entry[1]
+
+        with self.lock:
+            entry = self.codes.get(key)
+            if entry is not None:
+                # Another thread just added it
+                return entry[1]
+            offsets: Dict[int, ExecutingInfo] = {}
+            self.codes[key] = (weakref.ref(code, self.remover(key)), offsets)
+            if max_codes is not None:
+                while len(self.codes) > max(max_codes, 1):
+                    evicted, (_, evicted_offsets) = self.codes.popitem(last=False)
+                    self.tables.pop(evicted, None)
+                    self.unindex(evicted, evicted_offsets)
+        return offsets
+
+    def add_table(self, code: types.CodeType, table: List[Optional[ExecutingInfo]]) -> None:
+        sources = {info.source for info in table if info}
+        with self.lock:
+            # Unless it's already been evicted, in which case nothing would remove the table,
+            # or it refers to a source that has been evicted, in which case nothing would have
+            if id(code) in self.codes and all(self.source_cache.contains(source) for source in sources):
+                self.tables[id(code)] = table
+
+    def find(
+        self,
+        code: types.CodeType,
+        offsets: Dict[int, ExecutingInfo],
+        lasti: int,
+        find_info: Callable[[], ExecutingInfo],
+    ) -> ExecutingInfo:
+        """
+        Returns the result for `lasti` in `offsets` (from `self.offsets(code)`),
+        computing and caching it with `find_info` if needed.
+        Threads needing the same result at the same time wait for one of them to compute it.
+        """
+        key = id(code)
+
+        def compute() -> ExecutingInfo:
+            info = offsets.get(lasti)
+            if not info:
+                info = find_info()
+                self.store(key, offsets, lasti, info)
+            return info
+
+        return self.in_flight.run((key, lasti), compute)
+
+    def store(self, key: int, offsets: Dict[int, ExecutingInfo], lasti: int, info: ExecutingInfo) -> None:
+        with self.lock:
+            # If the source was evicted while the result was being found,
+            # `forget` has already run for it and wouldn't remove the result
+            if not self.source_cache.contains(info.source):
+                return
+            offsets[lasti] = info
+            entry = self.codes.get(key)
+            if entry is None or entry[1] is not offsets:
+                # The code object has been evicted, so `offsets` is unreachable anyway
+                return
+            indexed = self.by_source.get(id(info.source))
+            if indexed is None:
+                indexed = self.by_source[id(info.source)] = (info.source, set())
+            indexed[1].add(key)
+
+    def unindex(self, key: int, offsets: Dict[int, ExecutingInfo]) -> None:
+        """
+        Removes the evicted code object `key` with results `offsets` from `by_source`.
+        """
+        with self.lock:
+            for source_id in {id(info.source) for info in offsets.values()}:
+                indexed = self.by_source.get(source_id)
+                if indexed is not None:
+                    indexed[1].discard(key)
+                    if not indexed[1]:
+                        del self.by_source[source_id]
+
+    def remover(self, key: int) -> Callable[[weakref.ref], None]:
+        def remove(ref: weakref.ref) -> None:
+            with self.lock:
+                entry = self.codes.get(key)
+                # The entry may have been evicted and replaced by one for a new code object with the same id
+                if entry is not None and entry[0] is ref:
+                    del self.codes[key]
+                    self.tables.pop(key, None)
+                    self.unindex(key, entry[1])
+
+        return remove
+
+    def forget(self, sources: List[Source]) -> None:
+        with self.lock:
+            for source in sources:
+                indexed = self.by_source.pop(id(source), None)
+                # The index references the source, so its id can't have been reused
+                if indexed is None:
+                    continue
+                for key in indexed[1]:
+                    entry = self.codes.get(key)
+                    if entry is None:
+                        continue
+                    offsets = entry[1]
+                    for lasti, info in list(offsets.items()):
+                        if info.source is source:
+                            del offsets[lasti]
+                    self.tables.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.codes.clear()
+            self.tables.clear()
+            self.by_source.clear()
+
+
+class ExecutingInfo(object):
+    """
+    Everything in `Executing` except the frame, i.e. what was found for one instruction
+    of a code object. Unlike `Executing`, keeping one doesn't keep the frame's local variables alive.
+
+    These are immutable and are what `Source` caches, so the same object
+    is returned for every frame executing the same instruction.
+    The code object is only referenced weakly, so `code` is None
+    once it's been garbage collected.
+    """
+
+    __slots__ = ("source", "node", "statements", "decorator", "_code_ref")
+
+    source: Source
+    node: Optional[ast.AST]
+    statements: Set[ast.stmt]
+    decorator: Optional[EnhancedAST]
+    _code_ref: weakref.ref
+
+    def __init__(self, source: Source, node: Optional[ast.AST], statements: Set[ast.stmt], decorator: Optional[EnhancedAST], code: types.CodeType) -> None:
+        set_slot = object.__setattr__
+        set_slot(self, "source", source)
+        set_slot(self, "node", node)
+        set_slot(self, "statements", statements)
+        set_slot(self, "decorator", decorator)
+        set_slot(self, "_code_ref", weakref.ref(code))
+
+    def _replace(self, **changes: Any) -> "ExecutingInfo":
+        """
+        Returns a copy with the given attributes changed, like `namedtuple._replace`.
+        """
+        result = object.__new__(ExecutingInfo)
+        for name in self.__slots__:
+            object.__setattr__(result, name, changes.pop(name, getattr(self, name)))
+        if changes:
+            raise TypeError("Unexpected attributes: %s" % ", ".join(sorted(changes)))
+        return result
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("ExecutingInfo objects are immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("ExecutingInfo objects are immutable")
+
+    @property
+    def code(self) -> Optional[types.CodeType]:
+        return self._code_ref()
+
+    def code_qualname(self) -> str:
+        code = self.code
+        assert code is not None
+        return self.source.code_qualname(code)
+
+    def text(self) -> str:
+        return self.source.get_text(self.node)
+
+    def text_range(self) -> Tuple[int, int]:
+        return self.source.get_text_range(self.node)
+
+
 class Executing(object):
     """
     Information about the operation a frame is currently executing.
@@ -354,23 +1149,75 @@ class Executing(object):
         - `node` is a function or class definition
         - `decorator` is the expression in `node.decorator_list` being called
         - `statements == {node}`
+
+    This is just the frame and its `ExecutingInfo`, which is better to keep
+    when the frame isn't needed. Setting `source`, `node`, `statements` or `decorator`
+    replaces `info` with a changed copy, so the cached `ExecutingInfo` is left alone.
     """
 
-    def __init__(self, frame: types.FrameType, source: Source, node: EnhancedAST, stmts: Set[ast.stmt], decorator: Optional[EnhancedAST]) -> None:
+    __slots__ = ("frame", "info")
+
+    def __init__(
+        self,
+        frame: types.FrameType,
+        source: Source,
+        node: Optional[ast.AST],
+        stmts: Set[ast.stmt],
+        decorator: Optional[EnhancedAST],
+    ) -> None:
         self.frame = frame
-        self.source = source
-        self.node = node
-        self.statements = stmts
-        self.decorator = decorator
+        self.info = ExecutingInfo(source, node, stmts, decorator, frame.f_code)
+
+    @classmethod
+    def from_info(cls, frame: types.FrameType, info: ExecutingInfo) -> "Executing":
+        """
+        Returns an `Executing` for `frame` which shares `info` rather than copying it.
+        """
+        result = cls.__new__(cls)
+        result.frame = frame
+        result.info = info
+        return result
+
+    @property
+    def source(self) -> Source:
+        return self.info.source
+
+    @source.setter
+    def source(self, source: Source) -> None:
+        self.info = self.info._replace(source=source)
+
+    @property
+    def node(self) -> Optional[ast.AST]:
+        return self.info.node
+
+    @node.setter
+    def node(self, node: Optional[ast.AST]) -> None:
+        self.info = self.info._replace(node=node)
+
+    @property
+    def statements(self) -> Set[ast.stmt]:
+        return self.info.statements
+
+    @statements.setter
+    def statements(self, statements: Set[ast.stmt]) -> None:
+        self.info = self.info._replace(statements=statements)
+
+    @property
+    def decorator(self) -> Optional[EnhancedAST]:
+        return self.info.decorator
+
+    @decorator.setter
+    def decorator(self, decorator: Optional[EnhancedAST]) -> None:
+        self.info = self.info._replace(decorator=decorator)
 
     def code_qualname(self) -> str:
-        return self.source.code_qualname(self.frame.f_code)
+        return self.info.source.code_qualname(self.frame.f_code)
 
     def text(self) -> str:
-        return self.source._asttext_base().get_text(self.node)
+        return self.info.text()
 
     def text_range(self) -> Tuple[int, int]:
-        return self.source._asttext_base().get_text_range(self.node)
+        return self.info.text_range()
 
 
 class QualnameVisitor(ast.NodeVisitor):
@@ -448,21 +1295,128 @@ def compile_similar_to(source: ast.Module, matching_code: types.CodeType) -> Any
 
 sentinel = 'io8urthglkjdghvljusketgIYRFYUVGHFRTBGVHKGF78678957647698'
 
-def is_rewritten_by_pytest(code: types.CodeType) -> bool:
-    return any(
-        bc.opname != "LOAD_CONST" and isinstance(bc.argval,str) and bc.argval.startswith("@py")
-        for bc in get_instructions(code)
+
+def is_sentinel(value: Any) -> bool:
+    # Several expressions can be wrapped at once with different sentinels
+    # made by adding a suffix to this one
+    return isinstance(value, str) and value.startswith(sentinel)
+
+
+def sentinel_wrapper(constant: str, node: ast.AST) -> ast.AST:
+    # noinspection PyArgumentList
+    replacement = ast.BinOp(
+        left=cast(ast.expr, node),
+        op=ast.Pow(),
+        right=ast.Constant(constant),
+    )
+    ast.fix_missing_locations(replacement)
+    return replacement
+
+
+class CodeInfo(object):
+    """
+    What the node finders need to know about a code object,
+    decoded once and shared by every lookup in it. See `code_info`.
+
+    From 3.11 only the opnames and positions are read from the code up front,
+    straight from `co_code` and `co_positions()`. `PositionNodeFinder` decodes
+    the few instructions it looks at into `decoded`, and `instructions` is empty.
+    """
+
+    __slots__ = (
+        "instructions",
+        "offsets",
+        "instruction_offsets",
+        "opnames",
+        "positions",
+        "decoded",
+        "clean_instructions",
+        "is_pytest",
+        "is_ipython_cell",
     )
 
+    def __init__(self, code: types.CodeType) -> None:
+        instructions: List[EnhancedInstruction] = []
+        positions: List[Tuple[Optional[int], ...]] = []
+        if sys.version_info >= (3, 11):
+            opcodes = code.co_code[::2]
+            cache = dis.opmap["CACHE"]
+            # Inline cache entries are zeroed in co_code and aren't instructions
+            offsets = [i * 2 for i, op in enumerate(opcodes) if op != cache]
+            opnames = [dis.opname[op] for op in opcodes if op != cache]
+            # One entry per code unit, including the caches
+            positions = list(code.co_positions())
+        else:
+            # These also have a `lineno` for every instruction
+            instructions = list(get_instructions(code))
+            offsets = [inst.offset for inst in instructions]
+            opnames = [inst.opname for inst in instructions]
+
+        self.instructions = instructions
+        self.instruction_offsets = offsets
+        # Maps the offset of each instruction to its index in `instruction_offsets`
+        self.offsets = {offset: i for i, offset in enumerate(offsets)}
+        self.opnames = opnames
+        self.positions = positions
+        self.decoded: Dict[int, Any] = {}
+        self.clean_instructions = [
+            inst
+            for inst in instructions
+            if inst.opname not in ("EXTENDED_ARG", "NOP")
+        ]
+        # Names like @py_assert1 only come from pytest's assertion rewriting
+        self.is_pytest = any(
+            name.startswith("@py")
+            for names in (code.co_names, code.co_varnames, code.co_cellvars, code.co_freevars)
+            for name in names
+        )
+        self.is_ipython_cell = is_ipython_cell_code(code)
+
+
+# Keyed by id, like _ExecutingCache, since code objects compare by value
+code_infos: Dict[int, Tuple[weakref.ref, CodeInfo]] = {}
+code_infos_lock = RLock()
+
+
+def code_info(code: types.CodeType) -> CodeInfo:
+    """
+    Returns the `CodeInfo` of `code`, which is only referenced weakly.
+    """
+    key = id(code)
+    entry = code_infos.get(key)
+    if entry is not None and entry[0]() is code:
+        return entry[1]
+
+    def remove(ref: weakref.ref) -> None:
+        with code_infos_lock:
+            # The entry may have been replaced by one for a new code object with the same id
+            if code_infos.get(key, (None,))[0] is ref:
+                del code_infos[key]
+
+    info = CodeInfo(code)
+    with code_infos_lock:
+        code_infos[key] = (weakref.ref(code, remove), info)
+    return info
+
+
+def is_rewritten_by_pytest(code: types.CodeType) -> bool:
+    return code_info(code).is_pytest
+
 
 class SentinelNodeFinder(object):
     result: Optional[EnhancedAST] = None
 
-    def __init__(self, frame: types.FrameType, stmts: Set[EnhancedAST], tree: ast.Module, lasti: int, source: Source) -> None:
+    def __init__(self, code: types.CodeType, lineno: int, stmts: Set[EnhancedAST], tree: ast.Module, lasti: int, source: Source) -> None:
+        # IPython compiles each top-level statement of a cell separately (see find_node_ipython),
+        # so `tree` may only hold some of the statements on the line.
+        # Nodes in other statements can't be wrapped in a copy of `tree`.
+        top_level = set(tree.body)
+        stmts = {stmt for stmt in stmts if top_level_statement(stmt) in top_level}
         assert_(stmts)
-        self.frame = frame
+        self.lineno = lineno
         self.tree = tree
-        self.code = code = frame.f_code
+        self.code = code
+        self.scope = enclosing_scope(stmts)
         self.is_pytest = is_rewritten_by_pytest(code)
 
         if self.is_pytest:
@@ -532,29 +1486,42 @@ class SentinelNodeFinder(object):
             raise RuntimeError(op_name)
 
 
-        with lock:
-            exprs = {
-                cast(EnhancedAST, node)
-                for stmt in stmts
-                for node in ast.walk(stmt)
-                if isinstance(node, typ)
-                if isinstance(getattr(node, "ctx", None), ctx)
-                if extra_filter(node)
-                if statement_containing_node(node) == stmt
-            }
+        candidates = [
+            cast(EnhancedAST, node)
+            for stmt in stmts
+            for node in ast.walk(stmt)
+            if isinstance(node, typ)
+            if isinstance(getattr(node, "ctx", None), ctx)
+            if source._nodes_by_line.statement_containing(node) == stmt
+        ]
+        exprs = {node for node in candidates if extra_filter(node)}
 
-            if ctx == ast.Store:
-                # No special bytecode tricks here.
-                # We can handle multiple assigned attributes with different names,
-                # but only one assigned subscript.
-                self.result = only(exprs)
-                return
+        if ctx == ast.Store:
+            # No special bytecode tricks here.
+            # We can handle multiple assigned attributes with different names,
+            # but only one assigned subscript.
+            self.result = only(exprs)
+            return
 
-            matching = list(self.matching_nodes(exprs))
-            if not matching and typ == ast.Call:
-                self.find_decorator(stmts)
-            else:
-                self.result = only(matching)
+        original_instructions = self.get_original_clean_instructions()
+        original_index = only(
+            i
+            for i, inst in enumerate(original_instructions)
+            if inst == self.instruction
+        )
+        tables = source._sentinel_tables.setdefault(code, {})
+        key = (typ, ctx, frozenset(stmts))
+        if key not in tables:
+            tables[key] = self.sentinel_table(candidates, original_instructions)
+        table = tables[key]
+        if table is None:
+            matching = list(self.matching_nodes(exprs, original_instructions, original_index))
+        else:
+            matching = [expr for expr in table.get(original_index, []) if expr in exprs]
+        if not matching and typ == ast.Call:
+            self.find_decorator(stmts)
+        else:
+            self.result = only(matching)
 
     def find_decorator(self, stmts: Union[List[EnhancedAST], Set[EnhancedAST]]) -> None:
         stmt = only(stmts)
@@ -564,7 +1531,7 @@ class SentinelNodeFinder(object):
         line_instructions = [
             inst
             for inst in self.clean_instructions(self.code)
-            if inst.lineno == self.frame.f_lineno
+            if inst.lineno == self.lineno
         ]
         last_decorator_instruction_index = [
             i
@@ -589,10 +1556,10 @@ class SentinelNodeFinder(object):
         self.result = stmt
 
     def clean_instructions(self, code: types.CodeType) -> List[EnhancedInstruction]:
+        # Always a new list since handle_jumps modifies it
         return [
             inst
-            for inst in get_instructions(code)
-            if inst.opname not in ("EXTENDED_ARG", "NOP")
+            for inst in code_info(code).clean_instructions
             if inst.lineno not in self.ignore_linenos
         ]
 
@@ -603,7 +1570,10 @@ class SentinelNodeFinder(object):
         # inserts JUMP_IF_NOT_DEBUG instructions in bytecode
         # If they're not present in our compiled instructions,
         # ignore them in the original bytecode
-        if not any(
+        if any(
+                inst.opname == "JUMP_IF_NOT_DEBUG"
+                for inst in result
+        ) and not any(
                 inst.opname == "JUMP_IF_NOT_DEBUG"
                 for inst in self.compile_instructions()
         ):
@@ -614,28 +1584,71 @@ class SentinelNodeFinder(object):
 
         return result
 
-    def matching_nodes(self, exprs: Set[EnhancedAST]) -> Iterator[EnhancedAST]:
-        original_instructions = self.get_original_clean_instructions()
-        original_index = only(
-            i
-            for i, inst in enumerate(original_instructions)
-            if inst == self.instruction
-        )
-        for expr_index, expr in enumerate(exprs):
-            setter = get_setter(expr)
-            assert setter is not None
-            # noinspection PyArgumentList
-            replacement = ast.BinOp(
-                left=cast(ast.expr,expr),
-                op=ast.Pow(),
-                right=ast.Constant(sentinel),
-            )
-            ast.fix_missing_locations(replacement)
-            setter(replacement)
+    def sentinel_table(
+        self, candidates: List[EnhancedAST], original_instructions: List[EnhancedInstruction]
+    ) -> Optional[Dict[int, List[EnhancedAST]]]:
+        """
+        Wraps all the candidates at once, each with a different sentinel,
+        and compiles them a single time. The candidates must all be in `self.tree`,
+        which may only hold some of the statements on the line (see `__init__`).
+        Returns a dict mapping each index in `original_instructions`
+        to the candidates whose last instruction is at that index.
+        The table is stored by the caller so that other instructions
+        of the same kind in the same statements can reuse it.
+        Returns None if the wrapped code doesn't line up with the original code,
+        e.g. because of jumps or duplicated code in 3.10+,
+        in which case matching_nodes has to try each candidate separately.
+        """
+        sentinels = {}
+        wrappers: Dict[ast.AST, Callable[[ast.AST], ast.AST]] = {}
+        for i, expr in enumerate(candidates):
+            constant = "%s_%d" % (sentinel, i)
+            sentinels[constant] = expr
+            wrappers[expr] = partial(sentinel_wrapper, constant)
+        instructions = self.compile_instructions(wrappers)
+
+        if sys.version_info >= (3, 10):
             try:
-                instructions = self.compile_instructions()
-            finally:
-                setter(expr)
+                handle_jumps(instructions, original_instructions)
+            except Exception:
+                return None
+
+        table: Dict[int, List[EnhancedAST]] = {}
+        new_instructions: List[EnhancedInstruction] = []
+        instructions_iter = iter(instructions)
+        for inst in instructions_iter:
+            if not is_sentinel(inst.argval):
+                new_instructions.append(inst)
+                continue
+            power = next(instructions_iter, None)
+            if not (
+                    inst.opname == "LOAD_CONST"
+                    and power
+                    and power.opname == "BINARY_POWER"
+                    and new_instructions
+            ):
+                return None
+            table.setdefault(len(new_instructions) - 1, []).append(sentinels[inst.argval])
+
+        if not (
+                len(new_instructions) == len(original_instructions)
+                and all(map(opnames_match, original_instructions, new_instructions))
+        ):
+            return None
+
+        return table
+
+    def matching_nodes(
+        self,
+        exprs: Set[EnhancedAST],
+        original_instructions: List[EnhancedInstruction],
+        original_index: int,
+    ) -> Iterator[EnhancedAST]:
+        for expr_index, expr in enumerate(exprs):
+            wrappers: Dict[ast.AST, Callable[[ast.AST], ast.AST]] = {
+                expr: partial(sentinel_wrapper, sentinel)
+            }
+            instructions = self.compile_instructions(wrappers)
 
             if sys.version_info >= (3, 10):
                 try:
@@ -649,7 +1662,7 @@ class SentinelNodeFinder(object):
             indices = [
                 i
                 for i, instruction in enumerate(instructions)
-                if instruction.argval == sentinel
+                if is_sentinel(instruction.argval)
             ]
 
             # There can be several indices when the bytecode is duplicated,
@@ -696,8 +1709,12 @@ class SentinelNodeFinder(object):
 
                 yield expr
 
-    def compile_instructions(self) -> List[EnhancedInstruction]:
-        module_code = compile_similar_to(self.tree, self.code)
+    def compile_instructions(
+        self, wrappers: Optional[Dict[ast.AST, Callable[[ast.AST], ast.AST]]] = None
+    ) -> List[EnhancedInstruction]:
+        # The shared tree is never modified, so other threads can keep using it
+        tree = copy_scope(self.tree, self.scope, wrappers)
+        module_code = compile_similar_to(tree, self.code)
         code = only(self.find_codes(module_code))
         return self.clean_instructions(code)
 
@@ -744,12 +1761,9 @@ class SentinelNodeFinder(object):
         # Don't use get_original_clean_instructions
         # because we need the actual instructions including
         # EXTENDED_ARG
-        instructions = list(get_instructions(self.code))
-        index = only(
-            i
-            for i, inst in enumerate(instructions)
-            if inst.offset == lasti
-        )
+        info = code_info(self.code)
+        instructions = info.instructions
+        index = info.offsets[lasti]
 
         while True:
             instruction = instructions[index]
@@ -766,7 +1780,7 @@ def non_sentinel_instructions(instructions: List[EnhancedInstruction], start: in
     """
     skip_power = False
     for i, inst in islice(enumerate(instructions), start, None):
-        if inst.argval == sentinel:
+        if is_sentinel(inst.argval):
             assert_(inst.opname == "LOAD_CONST")
             skip_power = True
             continue
@@ -948,26 +1962,102 @@ def opnames_match(inst1: Instruction, inst2: Instruction) -> bool:
     )
 
 
-def get_setter(node: EnhancedAST) -> Optional[Callable[[ast.AST], None]]:
-    parent = node.parent
-    for name, field in ast.iter_fields(parent):
-        if field is node:
-            def setter(new_node: ast.AST) -> None:
-                return setattr(parent, name, new_node)
-            return setter
-        elif isinstance(field, list):
-            for i, item in enumerate(field):
-                if item is node:
-                    def setter(new_node: ast.AST) -> None:
-                        field[i] = new_node
-
-                    return setter
-    return None
+def enclosing_scope(stmts: Iterable[EnhancedAST]) -> Optional[EnhancedAST]:
+    """
+    Returns the outermost of the functions or classes directly containing `stmts`,
+    or None if any of them is at module level.
+    """
+    scopes = []
+    for stmt in stmts:
+        node = stmt.parent
+        while not isinstance(node, (ast.ClassDef,) + function_node_types):
+            if isinstance(node, ast.Module):
+                return None
+            node = node.parent
+        scopes.append(node)
+
+    def depth(node: EnhancedAST) -> int:
+        result = 0
+        while not isinstance(node, ast.Module):
+            node = node.parent
+            result += 1
+        return result
+
+    return min(scopes, key=depth)
+
+
+def copy_scope(
+    tree: ast.Module,
+    scope: Optional[EnhancedAST],
+    wrappers: Optional[Dict[ast.AST, Callable[[ast.AST], ast.AST]]] = None,
+) -> ast.Module:
+    """
+    Returns a module holding just `scope`, a function or class from `tree`,
+    and the chain of functions and classes around it, to compile instead of the whole `tree`.
+    Line numbers are unchanged. Other statements in the enclosing classes and the module
+    are left out since they don't affect the code of `scope`,
+    but enclosing functions are kept whole because their variables might be used in it.
+    If `scope` is None, the whole module is kept.
+    Each node in `wrappers` is replaced by the result of calling its wrapper
+    with (a copy of) the node, so nested nodes can be wrapped too.
+    `tree` isn't modified: only the module and the ancestors of `scope`
+    and the wrapped nodes are copied, everything else is shared.
+    """
+    wrappers = wrappers or {}
+    if scope is None and not wrappers:
+        return tree
 
-lock = RLock()
+    top_level = set(tree.body)
+
+    def ancestors(node: EnhancedAST) -> Optional[List[EnhancedAST]]:
+        """
+        Returns the ancestors of `node` up to the statement in `tree.body` containing it,
+        or None if `node` isn't in `tree`, which may only hold some of the statements
+        of the module that the parent links lead to (see find_node_ipython).
+        """
+        result = []
+        while node not in top_level:
+            node = node.parent
+            if isinstance(node, ast.Module):
+                return None
+            result.append(node)
+        return result
+
+    pruned = set(ancestors(scope) or ()) if scope is not None else set()
+    copied = set(pruned)
+    in_tree = {}
+    for node, wrapper in wrappers.items():
+        chain = ancestors(cast(EnhancedAST, node))
+        if chain is not None:
+            copied.update(chain)
+            in_tree[node] = wrapper
+    wrappers = in_tree
+    kept = copied | set(wrappers) | {scope}
+
+    def copy_node(node: Any) -> Any:
+        result = node
+        if node in copied:
+            result = copy(node)
+            for name, field in ast.iter_fields(node):
+                if isinstance(field, list):
+                    if name == "body" and node in pruned and isinstance(node, ast.ClassDef):
+                        field = [item for item in field if item in kept]
+                    setattr(result, name, [copy_node(item) for item in field])
+                elif isinstance(field, ast.AST):
+                    setattr(result, name, copy_node(field))
+        if node in wrappers:
+            result = wrappers[node](result)
+        return result
+
+    module = copy(tree)
+    module.body = [
+        copy_node(stmt)
+        for stmt in tree.body
+        if scope is None or stmt in kept
+    ]
+    return module
 
 
-@cache
 def statement_containing_node(node: ast.AST) -> EnhancedAST:
     while not isinstance(node, ast.stmt):
         node = cast(EnhancedAST, node).parent
@@ -976,20 +2066,23 @@ def statement_containing_node(node: ast.AST) -> EnhancedAST:
 
 def assert_linenos(tree: ast.AST) -> Iterator[int]:
     for node in ast.walk(tree):
-        if (
-                hasattr(node, 'parent') and
-                isinstance(statement_containing_node(node), ast.Assert)
-        ):
-            for lineno in node_linenos(node):
-                yield lineno
+        if isinstance(node, ast.Assert):
+            for child in ast.walk(node):
+                for lineno in node_linenos(child):
+                    yield lineno
+
+
+def top_level_statement(stmt: EnhancedAST) -> EnhancedAST:
+    while not isinstance(stmt.parent, ast.Module):
+        stmt = stmt.parent
+    return stmt
 
 
 def _extract_ipython_statement(stmt: EnhancedAST) -> ast.Module:
     # IPython separates each statement in a cell to be executed separately
     # So NodeFinder should only compile one statement at a time or it
     # will find a code mismatch.
-    while not isinstance(stmt.parent, ast.Module):
-        stmt = stmt.parent
+    stmt = top_level_statement(stmt)
     # use `ast.parse` instead of `ast.Module` for better portability
     # python3.8 changes the signature of `ast.Module`
     # Inspired by https://github.com/pallets/werkzeug/pull/1552/files
@@ -1014,12 +2107,12 @@ def is_ipython_cell_code(code_obj: types.CodeType) -> bool:
     )
 
 
-def find_node_ipython(frame: types.FrameType, lasti: int, stmts: Set[EnhancedAST], source: Source) -> Tuple[Optional[Any], Optional[Any]]:
+def find_node_ipython(code: types.CodeType, lineno: int, lasti: int, stmts: Set[EnhancedAST], source: Source) -> Tuple[Optional[Any], Optional[Any]]:
     node = decorator = None
     for stmt in stmts:
         tree = _extract_ipython_statement(stmt)
         try:
-            node_finder = NodeFinder(frame, stmts, tree, lasti, source)
+            node_finder = NodeFinder(code, lineno, stmts, tree, lasti, source)
             if (node or decorator) and (node_finder.result or node_finder.decorator):
                 # Found potential nodes in separate statements,
                 # cannot resolve ambiguity, give up here
@@ -1033,6 +2126,467 @@ def find_node_ipython(frame: types.FrameType, lasti: int, stmts: Set[EnhancedAST
 
 
 
+class ModuleIndex(object):
+    """
+    Lazily built index of the nodes of a module by the lines they overlap.
+
+    Each top-level statement is indexed the first time one of the lines it covers
+    is looked up: its nodes get a `parent` attribute, they are added to a `NodesByLine`
+    and mapped to the innermost statement containing them, and the qualnames of the functions and classes it contains are added to `qualnames`.
+    """
+
+    def __init__(self, tree: Optional[ast.Module]) -> None:
+        self.qualnames: Dict[Tuple[str, int], str] = {}
+        self.statements: List[ast.stmt] = []
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.complete = tree is None
+        self.all_qualnames = self.complete
+        # The innermost statement containing each indexed node, by id
+        self.statements_by_node: Dict[int, EnhancedAST] = {}
+        # Saved `NodesByLine` data for each statement, see `load`
+        self.tables: Optional[List[Any]] = None
+
+        if tree is not None:
+            for stmt in tree.body:
+                cast(EnhancedAST, stmt).parent = cast(EnhancedAST, tree)
+                self.statements.append(stmt)
+                self.starts.append(min(
+                    node.lineno
+                    for node in [stmt] + getattr(stmt, "decorator_list", [])
+                ))
+                self.ends.append(cast(int, stmt.end_lineno))
+
+        self.indexes: List[Optional[NodesByLine]] = [None] * len(self.statements)
+
+    def __getitem__(self, lineno: int) -> List[EnhancedAST]:
+        """
+        Returns the nodes overlapping the given line.
+        """
+        result: List[EnhancedAST] = []
+        for index in self.index_line(lineno):
+            index.spanning.find(lineno, result)
+            result.extend(index.starting.get(lineno, ()))
+        return result
+
+    def index_line(self, lineno: int) -> List[NodesByLine]:
+        """
+        Ensures that the top-level statements covering the given line are indexed
+        and returns their indexes.
+        """
+        # Statements don't overlap, so `ends` is also sorted
+        stop = bisect_right(self.starts, lineno)
+        start = stop
+        while start > 0 and self.ends[start - 1] >= lineno:
+            start -= 1
+
+        # Qualnames are added with setdefault, so statements sharing a line
+        # must be indexed in order to give the same results as indexing everything.
+        first = start
+        while start < stop and first > 0 and self.ends[first - 1] >= self.starts[first]:
+            first -= 1
+        for i in range(first, start):
+            self.index_statement(i)
+
+        return [self.index_statement(i) for i in range(start, stop)]
+
+    def nodes_at(
+        self, lineno: int, col_offset: Optional[int], end_lineno: Optional[int], end_col_offset: Optional[int]
+    ) -> List[EnhancedAST]:
+        """
+        Returns the nodes with exactly the given positions.
+        """
+        key = (lineno, col_offset, end_lineno, end_col_offset)
+        result: List[EnhancedAST] = []
+        for index in self.index_line(lineno):
+            result.extend(index.positions()[0].get(key, ()))
+        return result
+
+    def nodes_ending_at(
+        self, lineno: int, end_lineno: Optional[int], end_col_offset: Optional[int]
+    ) -> List[EnhancedAST]:
+        """
+        Returns the nodes overlapping `lineno`, as in `self[lineno]`,
+        that end at the given position.
+        """
+        result: List[EnhancedAST] = []
+        for index in self.index_line(lineno):
+            for node in index.positions()[1].get((end_lineno, end_col_offset), ()):
+                start = cast(int, node.lineno) # type: ignore[attr-defined]
+                if start == lineno or isinstance(node, ast.expr) and start < lineno:
+                    result.append(node)
+        return result
+
+    def statement_containing(self, node: EnhancedAST) -> EnhancedAST:
+        """
+        Like `statement_containing_node`, for a node in an indexed statement.
+        """
+        return self.statements_by_node.get(id(node)) or statement_containing_node(node)
+
+    def index_statement(self, i: int) -> NodesByLine:
+        index = self.indexes[i]
+        if index is None:
+            stmt = self.statements[i]
+            nodes = walk_with_parents(stmt, self.statements_by_node)
+            if self.tables is None:
+                visitor = QualnameVisitor()
+                visitor.qualnames = self.qualnames
+                visitor.visit(stmt)
+                index = NodesByLine(nodes)
+            else:
+                index = NodesByLine.from_table(nodes, self.tables[i])
+            self.indexes[i] = index
+        return index
+
+    def index_all(self) -> None:
+        if not self.complete:
+            for i in range(len(self.statements)):
+                self.index_statement(i)
+            self.complete = True
+            self.all_qualnames = True
+
+    def dump(self) -> Any:
+        """
+        Returns the complete index as plain data that can be serialized with `marshal`
+        and passed to `load` for the same tree.
+        """
+        self.index_all()
+        return (
+            self.starts,
+            self.ends,
+            [(name, lineno, qualname) for (name, lineno), qualname in self.qualnames.items()],
+            [
+                index.table(walk_with_parents(stmt))
+                for stmt, index in zip(self.statements, cast(List[NodesByLine], self.indexes))
+            ],
+        )
+
+    def load(self, data: Any) -> bool:
+        """
+        Uses the result of `dump` for the same source instead of visiting the tree to get qualnames,
+        and to index statements more cheaply as they're needed.
+        Returns False, leaving the index unchanged, if `data` doesn't match the tree.
+        """
+        try:
+            starts, ends, qualnames, tables = data
+            if (
+                starts != self.starts
+                or ends != self.ends
+                or not isinstance(tables, list)
+                or len(tables) != len(self.statements)
+            ):
+                return False
+            qualnames = {(name, lineno): qualname for name, lineno, qualname in qualnames}
+        except (TypeError, ValueError):
+            return False
+        if not all(
+            isinstance(name, str) and isinstance(lineno, int) and isinstance(qualname, str)
+            for (name, lineno), qualname in qualnames.items()
+        ):
+            return False
+        # The tables themselves are checked by `NodesByLine.from_table` as they're needed
+
+        self.qualnames.update(qualnames)
+        self.all_qualnames = True
+        self.tables = tables
+        return True
+
+
+class NodesByLine(object):
+    """
+    Index of AST nodes by the lines they overlap, with the same semantics as `node_linenos`:
+    expressions overlap every line from `lineno` to `end_lineno`,
+    other nodes only overlap `lineno`.
+
+    Each node is stored once, under its first line in `starting`,
+    and expressions spanning several lines also in the `NodeIntervals` `spanning`,
+    rather than once for every line they overlap.
+    """
+
+    # See `positions`
+    _positions: Optional[Tuple[Dict[Any, List[EnhancedAST]], Dict[Any, List[EnhancedAST]]]] = None
+
+    def __init__(self, nodes: Iterable[ast.AST]) -> None:
+        self.starting: Dict[int, List[EnhancedAST]] = {}
+        intervals = []
+        for node in nodes:
+            if not hasattr(node, "lineno"):
+                continue
+            lineno = node.lineno # type: ignore[attr-defined]
+            self.starting.setdefault(lineno, []).append(cast(EnhancedAST, node))
+            end_lineno = getattr(node, "end_lineno", None)
+            if isinstance(node, ast.expr) and end_lineno is not None and end_lineno > lineno:
+                intervals.append((lineno + 1, end_lineno, cast(EnhancedAST, node)))
+        self.spanning = NodeIntervals.build(intervals)
+
+    @classmethod
+    def from_table(cls, nodes: List[EnhancedAST], table: Any) -> NodesByLine:
+        """
+        Rebuilds the index of `nodes` (as returned by `walk_with_parents`)
+        from the result of `table`, without looking at their positions.
+        If `table` doesn't fit `nodes`, e.g. because the file it was loaded from
+        is corrupt or belongs to different nodes after all, the positions are used instead.
+        """
+        if not cls.valid_table(table, len(nodes)):
+            return cls(nodes)
+        count, starting, spanning = table
+        self = cls.__new__(cls)
+        self.starting = {
+            lineno: [nodes[i] for i in positions]
+            for lineno, positions in starting
+        }
+        self.spanning = NodeIntervals.build(
+            (start, end, nodes[i])
+            for start, end, i in spanning
+        )
+        return self
+
+    @staticmethod
+    def valid_table(table: Any, count: int) -> bool:
+        """
+        Checks that `table` has the structure returned by `table` for a list of `count` nodes.
+        """
+        indices = range(count)
+        try:
+            table_count, starting, spanning = table
+            return (
+                table_count == count
+                and isinstance(starting, list)
+                and isinstance(spanning, list)
+                and all(
+                    isinstance(lineno, int)
+                    and isinstance(positions, list)
+                    and all(isinstance(i, int) and i in indices for i in positions)
+                    for lineno, positions in starting
+                )
+                and all(
+                    isinstance(start, int) and isinstance(end, int) and start <= end
+                    and isinstance(i, int) and i in indices
+                    for start, end, i in spanning
+                )
+            )
+        except (TypeError, ValueError):
+            return False
+
+    def table(self, nodes: List[EnhancedAST]) -> Any:
+        """
+        Returns this index as plain data, referring to nodes by their position in `nodes`.
+        """
+        positions = {id(node): i for i, node in enumerate(nodes)}
+        return (
+            len(nodes),
+            [
+                (lineno, [positions[id(node)] for node in line_nodes])
+                for lineno, line_nodes in self.starting.items()
+            ],
+            [
+                (start, end, positions[id(node)])
+                for start, end, node in self.spanning.items()
+            ],
+        )
+
+    def positions(self) -> Tuple[Dict[Any, List[EnhancedAST]], Dict[Any, List[EnhancedAST]]]:
+        """
+        Returns two dicts of the nodes, one keyed by
+        (lineno, col_offset, end_lineno, end_col_offset) and one by (end_lineno, end_col_offset).
+        They're only built the first time they're needed, since only `PositionNodeFinder` uses them.
+        """
+        positions = self._positions
+        if positions is None:
+            by_position: Dict[Any, List[EnhancedAST]] = {}
+            by_end: Dict[Any, List[EnhancedAST]] = {}
+            for line_nodes in self.starting.values():
+                for node in line_nodes:
+                    end = (getattr(node, "end_lineno", None), getattr(node, "end_col_offset", None))
+                    by_position.setdefault(
+                        (node.lineno, node.col_offset) + end, # type: ignore[attr-defined]
+                        [],
+                    ).append(node)
+                    by_end.setdefault(end, []).append(node)
+            positions = self._positions = (by_position, by_end)
+        return positions
+
+    def __getitem__(self, lineno: int) -> List[EnhancedAST]:
+        """
+        Returns the nodes overlapping the given line.
+        """
+        result = list(self.starting.get(lineno, ()))
+        self.spanning.find(lineno, result)
+        return result
+
+
+class NodeIntervals(object):
+    """
+    A nested containment list of nodes and their (start, end) line intervals.
+    The intervals in one list don't contain each other, so both `starts` and `ends` are sorted.
+    The intervals contained in the i-th interval are in `children[i]`, which is None if there are none.
+    Since AST nodes are nested, this mostly mirrors the structure of the tree.
+    """
+
+    __slots__ = ("starts", "ends", "nodes", "children")
+
+    def __init__(self) -> None:
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.nodes: List[EnhancedAST] = []
+        self.children: List[Optional[NodeIntervals]] = []
+
+    @classmethod
+    def build(cls, intervals: Iterable[Tuple[int, int, EnhancedAST]]) -> NodeIntervals:
+        root = cls()
+        # The chain of intervals containing the current one, as (end, list, index in list)
+        stack: List[Tuple[int, NodeIntervals, int]] = []
+        # Sorting by descending end puts containing intervals before those they contain
+        for start, end, node in sorted(intervals, key=lambda interval: (interval[0], -interval[1])):
+            while stack and stack[-1][0] < end:
+                stack.pop()
+            if stack:
+                _, owner, index = stack[-1]
+                container = owner.children[index]
+                if container is None:
+                    container = owner.children[index] = cls()
+            else:
+                container = root
+            container.starts.append(start)
+            container.ends.append(end)
+            container.nodes.append(node)
+            container.children.append(None)
+            stack.append((end, container, len(container.nodes) - 1))
+        return root
+
+    def find(self, lineno: int, result: List[EnhancedAST]) -> None:
+        """
+        Appends the nodes whose intervals contain `lineno` to `result`.
+        """
+        i = bisect_right(self.starts, lineno)
+        while i > 0:
+            i -= 1
+            if self.ends[i] < lineno:
+                # Earlier intervals end even earlier
+                break
+            result.append(self.nodes[i])
+            children = self.children[i]
+            if children is not None:
+                children.find(lineno, result)
+
+
+    def items(self) -> Iterator[Tuple[int, int, EnhancedAST]]:
+        """
+        Yields all the (start, end, node) intervals, including nested ones.
+        """
+        for start, end, node, children in zip(self.starts, self.ends, self.nodes, self.children):
+            yield start, end, node
+            if children is not None:
+                for item in children.items():
+                    yield item
+
+
+# Nodes without fields such as ast.Load() can be singletons shared by all trees.
+# Giving them a parent would keep the last tree alive, and they don't need one.
+shared_node_types = (ast.expr_context, ast.boolop, ast.operator, ast.unaryop, ast.cmpop)
+
+
+def walk_with_parents(
+    root: ast.AST, statements: Optional[Dict[int, EnhancedAST]] = None
+) -> List[EnhancedAST]:
+    """
+    Returns the same nodes in the same order as `ast.walk`,
+    setting the `parent` attribute of all but the root and shared nodes along the way.
+    If `statements` is given, the root must be a statement, and the innermost
+    statement containing each node is added to it under the id of the node.
+    """
+    nodes = [cast(EnhancedAST, root)]
+    if statements is not None:
+        statements[id(root)] = cast(EnhancedAST, root)
+    # The list grows while being iterated over, making it a breadth first traversal
+    for node in nodes:
+        statement = statements[id(node)] if statements is not None else None
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, shared_node_types):
+                cast(EnhancedAST, child).parent = node
+            nodes.append(cast(EnhancedAST, child))
+            if statements is not None:
+                statements[id(child)] = (
+                    cast(EnhancedAST, child) if isinstance(child, ast.stmt)
+                    else cast(EnhancedAST, statement)
+                )
+    return nodes
+
+
+def frame_position(
+    frame_or_tb: Union[types.TracebackType, types.FrameType]
+) -> Tuple[types.FrameType, int, int]:
+    """
+    Returns the frame, line number and instruction offset of a frame or traceback object.
+    """
+    if isinstance(frame_or_tb, types.TracebackType):
+        # https://docs.python.org/3/reference/datamodel.html#traceback-objects
+        # "tb_lineno gives the line number where the exception occurred;
+        #  tb_lasti indicates the precise instruction.
+        #  The line number and last instruction in the traceback may differ
+        #  from the line number of its frame object
+        #  if the exception occurred in a try statement with no matching except clause
+        #  or with a finally clause."
+        tb = frame_or_tb
+        frame = tb.tb_frame
+        lineno = tb.tb_lineno
+        lasti = tb.tb_lasti
+    else:
+        frame = frame_or_tb
+        lineno = frame.f_lineno
+        lasti = frame.f_lasti
+    return frame, lineno, lasti
+
+
+PYPY = 'pypy' in sys.version.lower()
+
+# Nodes that asttokens.ASTText can only find the text of with tokens,
+# because they have no positions or they're wrong (as are all positions on PyPy)
+tokens_needed_types: Tuple[str, ...] = ("arguments", "withitem")
+if sys.version_info < (3, 9):
+    tokens_needed_types += ("arg", "Starred", "Slice", "ExtSlice", "Index", "keyword")
+
+
+def last_statement(node: ast.AST) -> Any:
+    """
+    Returns the last statement nested in the compound statement `node`
+    (following the last child statement each time), or `node` itself if it has none.
+    """
+    while True:
+        statements = [
+            child for child in ast.iter_child_nodes(node)
+            if isinstance(child, (ast.stmt, ast.excepthandler)) or type(child).__name__ == "match_case"
+        ]
+        if not statements:
+            return node
+        node = statements[-1]
+
+
+def code_offset_linenos(code: types.CodeType) -> Iterator[Tuple[int, Optional[int]]]:
+    """
+    Yields the offset of every instruction in `code` along with
+    the line number that `frame.f_lineno` would have at that offset.
+    """
+    linestarts = dict(dis.findlinestarts(code))
+    lineno: Optional[int] = code.co_firstlineno
+    for inst in dis.get_instructions(code):
+        lineno = linestarts.get(inst.offset, lineno)
+        yield inst.offset, lineno
+
+
+def offset_lineno(code: types.CodeType, lasti: int) -> Optional[int]:
+    """
+    Returns the line number that `frame.f_lineno` would have at offset `lasti` of `code`,
+    the same as `code_offset_linenos` gives for that offset.
+    """
+    lineno: Optional[int] = code.co_firstlineno
+    for offset, line in dis.findlinestarts(code):
+        if offset > lasti:
+            break
+        lineno = line
+    return lineno
+
+
 def node_linenos(node: ast.AST) -> Iterator[int]:
     if hasattr(node, "lineno"):
         linenos: Sequence[int] = []
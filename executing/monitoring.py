@@ -0,0 +1,139 @@
+"""
+Resolves `sys.monitoring` (PEP 669) events to AST nodes, on Python 3.12+:
+
+    import sys
+    from executing.monitoring import NodeMonitor
+
+    def callback(event, code, offset, info, *args):
+        print(info.node)
+
+    with NodeMonitor(callback, sys.monitoring.events.CALL | sys.monitoring.events.RAISE):
+        ...
+
+The first event in each code object resolves all of its instructions at once
+with `Source.executing_map`, so later events only cost a couple of dict lookups.
+"""
+
+import sys
+import types
+from typing import Any, Callable, Dict, List, Optional, Type
+
+from .executing import ExecutingInfo, Source
+
+if sys.version_info < (3, 12):
+    raise ImportError("executing.monitoring needs sys.monitoring, which is new in Python 3.12")
+
+monitoring = sys.monitoring
+
+# Tool ids that PEP 669 doesn't set aside for debuggers, coverage, profilers or optimizers
+FREE_TOOL_IDS = (3, 4)
+
+# Every event whose callbacks get `(code, offset, ...)`, i.e. all except LINE
+SUPPORTED_EVENTS = 0
+for _name in dir(monitoring.events):
+    if _name.isupper() and _name != "LINE":
+        SUPPORTED_EVENTS |= getattr(monitoring.events, _name)
+
+
+def use_free_tool_id(tool_id: Optional[int], name: str) -> int:
+    """
+    Claims `tool_id` for `name`, or if it's None, the first free id in `FREE_TOOL_IDS`.
+    """
+    if tool_id is None:
+        tool_id = next(
+            (tool_id for tool_id in FREE_TOOL_IDS if monitoring.get_tool(tool_id) is None),
+            None,
+        )
+        if tool_id is None:
+            raise RuntimeError("All of the sys.monitoring tool ids %s are in use" % (FREE_TOOL_IDS,))
+
+    monitoring.use_tool_id(tool_id, name)
+    return tool_id
+
+
+class NodeMonitor(object):
+    """
+    Calls `callback(event, code, offset, info, *args)` for each of the `sys.monitoring` events
+    in the bitmask `events` while started, where `info` is the `ExecutingInfo`
+    that `source_class.executing_at(code, offset)` would return, and `args` are any
+    further arguments `sys.monitoring` gives for the event, e.g. the exception for RAISE.
+    The callback's return value is returned to `sys.monitoring`, so it can return
+    `sys.monitoring.DISABLE` for events that allow it.
+
+    Events aren't generated for code running inside the callback.
+    By default the first free tool id in `FREE_TOOL_IDS` is used.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[..., Any],
+        events: int,
+        source_class: Type[Source] = Source,
+        tool_id: Optional[int] = None,
+        name: str = "executing",
+    ) -> None:
+        if not events or events & ~SUPPORTED_EVENTS:
+            raise ValueError("Unsupported events: %r" % events)
+        self.callback = callback
+        self.events = events
+        self.source_class = source_class
+        self.tool_id = tool_id
+        self.name = name
+        self.active_tool_id: Optional[int] = None
+
+    def start(self) -> None:
+        if self.active_tool_id is not None:
+            raise RuntimeError("NodeMonitor is already started")
+
+        tool_id = use_free_tool_id(self.tool_id, self.name)
+        for event in self._event_bits():
+            monitoring.register_callback(tool_id, event, self._handler(event))
+        monitoring.set_events(tool_id, self.events)
+        self.active_tool_id = tool_id
+
+    def stop(self) -> None:
+        tool_id = self.active_tool_id
+        if tool_id is None:
+            return
+        monitoring.set_events(tool_id, monitoring.events.NO_EVENTS)
+        for event in self._event_bits():
+            monitoring.register_callback(tool_id, event, None)
+        monitoring.free_tool_id(tool_id)
+        self.active_tool_id = None
+
+    def __enter__(self) -> "NodeMonitor":
+        self.start()
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.stop()
+
+    def _event_bits(self) -> List[int]:
+        return [1 << i for i in range(self.events.bit_length()) if self.events & (1 << i)]
+
+    def _handler(self, event: int) -> Callable[..., Any]:
+        """
+        Returns the function registered with `sys.monitoring` for `event`.
+        """
+        callback = self.callback
+        resolve = self._resolve
+        # Shared with Source.executing etc., and only ever cleared in place
+        codes = self.source_class._executing_cache().codes
+
+        def handle(code: types.CodeType, offset: int, *args: Any) -> Any:
+            entry = codes.get(id(code))
+            info = entry[1].get(offset) if entry is not None else None
+            if info is None:
+                info = resolve(code, offset)
+            return callback(event, code, offset, info, *args)
+
+        return handle
+
+    def _resolve(self, code: types.CodeType, offset: int) -> ExecutingInfo:
+        """
+        Returns the `ExecutingInfo` for `offset`, resolving the rest of `code` at the same time.
+        """
+        # The frame which generated the event, to find the source of modules from zips etc.
+        module_globals: Optional[Dict[str, Any]] = sys._getframe(2).f_globals
+        self.source_class.executing_map(code, module_globals)
+        return self.source_class.executing_at(code, offset, module_globals=module_globals)
@@ -0,0 +1,149 @@
+"""
+A sampling profiler which finds the AST nodes, not just the lines, where time is spent:
+
+    from executing.sampling import NodeSampler
+
+    with NodeSampler() as sampler:
+        ...
+
+    for stats in sampler.report()[:10]:
+        print(stats.total_samples, stats.own_samples, stats.text())
+
+Sampling only counts the `(code, f_lasti)` positions in the stacks of other threads.
+They're resolved to nodes in bulk by `report()`.
+"""
+
+import sys
+import threading
+import types
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Type
+
+from .executing import EnhancedAST, Source, offset_lineno
+
+
+class NodeStats(NamedTuple):
+    """
+    The number of samples in which a node was executing. `own_samples` only counts
+    samples where it was in the innermost frame, and `total_samples` counts any frame.
+    Positions where no node was found are counted together per line, with `node` None.
+    """
+
+    source: Source
+    code: types.CodeType
+    node: Optional[EnhancedAST]
+    lineno: Optional[int]
+    own_samples: int
+    total_samples: int
+
+    def text(self) -> str:
+        """
+        The source code of the node like `Executing.text()`, or of the line if there's no node.
+        """
+        if self.node is not None:
+            return self.source.get_text(self.node)
+        if self.lineno is None:
+            return ""
+        return self.source.lines[self.lineno - 1].strip()
+
+
+class NodeSampler(object):
+    """
+    Samples the stacks of all other threads with `sys._current_frames()`
+    every `interval` seconds from a background thread while started.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.001,
+        source_class: Type[Source] = Source,
+    ) -> None:
+        self.interval = interval
+        self.source_class = source_class
+        # Keyed by id, since code objects compare (and hash) by value.
+        # The counts for each code object map offsets to [own samples, total samples].
+        self.counts: Dict[int, Tuple[types.CodeType, Dict[int, List[int]]]] = {}
+        self.samples = 0
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+
+    def start(self) -> None:
+        if self.thread is not None:
+            raise RuntimeError("NodeSampler is already started")
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="executing.NodeSampler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def __enter__(self) -> "NodeSampler":
+        self.start()
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.stop()
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            self.sample()
+
+    def sample(self) -> None:
+        """
+        Counts the current position of every frame in the stacks of all threads except this one.
+        """
+        counts = self.counts
+        current = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == current:
+                continue
+            own = 1
+            f: Optional[types.FrameType] = frame
+            while f is not None:
+                code = f.f_code
+                entry = counts.get(id(code))
+                if entry is None:
+                    entry = counts[id(code)] = (code, {})
+                offsets = entry[1]
+                lasti = f.f_lasti
+                position = offsets.get(lasti)
+                if position is None:
+                    offsets[lasti] = [own, 1]
+                else:
+                    position[0] += own
+                    position[1] += 1
+                own = 0
+                f = f.f_back
+        self.samples += 1
+
+    def report(self) -> List[NodeStats]:
+        """
+        Returns the counts of each node found for the sampled positions,
+        from most to least samples in total.
+        """
+        source_class = self.source_class
+        by_node: Dict[Any, List[Any]] = {}
+        for code, offsets in list(self.counts.values()):
+            for lasti, (own, total) in list(offsets.items()):
+                info = source_class.executing_at(code, lasti)
+                node = info.node
+                if node is not None:
+                    key: Any = node
+                    lineno = getattr(node, "lineno", None)
+                else:
+                    lineno = offset_lineno(code, lasti)
+                    key = (id(code), lineno)
+                stats = by_node.get(key)
+                if stats is None:
+                    by_node[key] = [info.source, code, node, lineno, own, total]
+                else:
+                    stats[4] += own
+                    stats[5] += total
+
+        result = [NodeStats(*stats) for stats in by_node.values()]
+        result.sort(key=lambda stats: (-stats.total_samples, -stats.own_samples))
+        return result
+
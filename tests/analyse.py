@@ -13,10 +13,6 @@ from rich import print as rprint
 import rich
 
 
-class Frame:
-    pass
-
-
 if len(sys.argv) <= 1 or sys.argv[1] in ("--help", "-h"):
     print(
         """
@@ -45,15 +41,8 @@ code = filename.read_text()
 
 
 def inspect_opcode(bytecode, index, lineno):
-    frame = Frame()
-    frame.f_lasti = index
-    frame.f_code = bytecode
-    frame.f_globals = globals()
-    frame.f_lineno = lineno
-    source = Source.for_frame(frame)
-
     try:
-        ex = Source.executing(frame)
+        ex = Source.executing_at(bytecode, index, lineno, globals())
     except RuntimeError:
         raise
     except Exception as e:
@@ -0,0 +1,657 @@
+"""
+Benchmarks for the caches and lookups in executing.
+
+Usage:
+
+    python -m tests.benchmarks [name ...]
+
+Runs all benchmarks if no names are given.
+"""
+
+import ast
+import dis
+import gc
+import inspect
+import linecache
+import os
+import shutil
+import sys
+import time
+import types
+from contextlib import contextmanager
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import executing.executing
+from executing import Source
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def report(*columns):
+    print("".join(str(column).rjust(18) for column in columns))
+
+
+@contextmanager
+def count_calls(module, name):
+    """
+    Replaces `module.name` with a wrapper counting its calls in `counter[0]`.
+    """
+    original = getattr(module, name)
+    counter = [0]
+
+    def wrapper(*args, **kwargs):
+        counter[0] += 1
+        return original(*args, **kwargs)
+
+    setattr(module, name, wrapper)
+    try:
+        yield counter
+    finally:
+        setattr(module, name, original)
+
+
+@benchmark
+def linecache_checks():
+    """
+    os.stat calls made by 10,000 lookups of Source.for_filename
+    for each value of Source.linecache_check_interval.
+    """
+    filename = inspect.getsourcefile(executing.executing)
+    lookups = 10000
+    report("interval", "stat calls", "us per lookup")
+    for interval in (0, 0.001, 1, None):
+
+        class BenchmarkSource(Source):
+            linecache_check_interval = interval
+
+        BenchmarkSource.for_filename(filename)
+        with count_calls(os, "stat") as stat_calls:
+            start = time.perf_counter()
+            for _ in range(lookups):
+                BenchmarkSource.for_filename(filename)
+            elapsed = time.perf_counter() - start
+        report(interval, stat_calls[0], "%.2f" % (elapsed / lookups * 1e6))
+
+
+@benchmark
+def disk_cache():
+    """
+    Milliseconds (best of 5) to construct a Source for a large module and then either
+    look up one qualname or index the whole tree, without Source.disk_cache_dir,
+    with it when the cache file has to be written, and when it is loaded.
+    """
+    import tempfile
+
+    filename = os.path.join(os.path.dirname(__file__), "samples", "datetime.py")
+    lines = linecache.getlines(filename)
+    code = compile("".join(lines), filename, "exec")
+    code = next(c for c in code.co_consts if isinstance(c, types.CodeType))
+
+    report("", "qualname", "whole tree")
+    with tempfile.TemporaryDirectory() as directory:
+
+        class DiskCachedSource(Source):
+            disk_cache_dir = directory
+
+        for name, cls, clear in [
+            ("no disk cache", Source, False),
+            ("saving", DiskCachedSource, True),
+            ("loading", DiskCachedSource, False),
+        ]:
+            row = [name]
+            for func in [lambda source: source.code_qualname(code), lambda source: source.tree]:
+                times = []
+                for _ in range(5):
+                    if clear:
+                        shutil.rmtree(directory, ignore_errors=True)
+                    gc.collect()
+                    start = time.perf_counter()
+                    func(cls(filename, lines))
+                    times.append(time.perf_counter() - start)
+                row.append("%.1f" % (min(times) * 1000))
+            report(*row)
+
+
+@benchmark
+def executing_map():
+    """
+    Milliseconds to resolve every instruction of the code objects in a module
+    with Source.executing on fake frames compared to Source.executing_map.
+    """
+    filename = os.path.join(os.path.dirname(__file__), "samples", "bird.py")
+    codes = [compile("".join(linecache.getlines(filename)), filename, "exec")]
+    for code in codes:
+        codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+
+    class Frame(object):
+        f_globals = {}
+
+    def each_offset(cls):
+        for code in codes:
+            linestarts = dict(dis.findlinestarts(code))
+            lineno = code.co_firstlineno
+            for inst in dis.get_instructions(code):
+                frame = Frame()
+                frame.f_code = code
+                frame.f_lasti = inst.offset
+                frame.f_lineno = lineno = linestarts.get(inst.offset, lineno)
+                cls.executing(frame)
+
+    def whole_codes(cls):
+        for code in codes:
+            cls.executing_map(code)
+
+    report("", "ms")
+    for func in [each_offset, whole_codes]:
+
+        class BenchmarkSource(Source):
+            pass
+
+        BenchmarkSource.for_filename(filename)
+        start = time.perf_counter()
+        func(BenchmarkSource)
+        report(func.__name__, "%.1f" % ((time.perf_counter() - start) * 1000))
+
+
+@benchmark
+def concurrency():
+    """
+    Source instances built and node finder runs when many threads call Source.executing
+    at the same time for the same new position in a large module.
+    """
+    import threading
+
+    # A fake frame calling ValueError(...) near the middle of the module
+    filename = os.path.join(os.path.dirname(__file__), "samples", "datetime.py")
+    module_code = compile("".join(linecache.getlines(filename)), filename, "exec")
+    code = next(
+        const for const in module_code.co_consts
+        if getattr(const, "co_name", None) == "_check_date_fields"
+    )
+    lineno = 522
+    line_start = dict((line, offset) for offset, line in dis.findlinestarts(code))[lineno]
+
+    class Frame(object):
+        f_code = code
+        f_lineno = lineno
+        f_lasti = next(
+            inst.offset for inst in dis.get_instructions(code)
+            if inst.opname.startswith("CALL") and inst.offset > line_start
+        )
+        f_globals = {}
+
+    report("threads", "sources built", "finder runs", "ms")
+    for thread_count in (1, 8, 64):
+        counts = {"init": 0, "find": 0}
+
+        class CountingSource(Source):
+            def __init__(self, *args):
+                counts["init"] += 1
+                super(CountingSource, self).__init__(*args)
+
+            def _find_node(self, *args):
+                counts["find"] += 1
+                return super(CountingSource, self)._find_node(*args)
+
+        barrier = threading.Barrier(thread_count + 1)
+
+        def run():
+            barrier.wait()
+            CountingSource.executing(Frame())
+
+        threads = [threading.Thread(target=run) for _ in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        report(thread_count, counts["init"], counts["find"], "%.1f" % (elapsed * 1000))
+
+
+@benchmark
+def long_line():
+    """
+    Microseconds per instruction to resolve every instruction of a function
+    whose body is one long line of method calls, with executing_map.
+    """
+    calls = ", ".join("a.m%d(b[%d] + c.d)" % (i, i) for i in range(200))
+    text = "def f(a, b, c):\n    return g(%s)\n" % calls
+    filename = "<long_line_benchmark>"
+    linecache.cache[filename] = (len(text), None, text.splitlines(True), filename)
+    code = compile(text, filename, "exec").co_consts[0]
+    instructions = len(list(dis.get_instructions(code)))
+
+    report("instructions", "us per instruction")
+    for _ in range(3):
+
+        class BenchmarkSource(Source):
+            pass
+
+        BenchmarkSource.for_filename(filename).tree
+        start = time.perf_counter()
+        BenchmarkSource.executing_map(code)
+        elapsed = time.perf_counter() - start
+        report(instructions, "%.1f" % (elapsed / instructions * 1e6))
+
+
+@benchmark
+def cold_lookup():
+    """
+    Microseconds for the first Source.executing call in a function
+    of one long line of method calls, when nothing about its code object is cached yet.
+    """
+    calls = ", ".join("a.m%d(b[%d] + c.d)" % (i, i) for i in range(200))
+    text = "def f(a, b, c):\n    return g(%s)\n" % calls
+    filename = "<cold_lookup_benchmark>"
+    linecache.cache[filename] = (len(text), None, text.splitlines(True), filename)
+    Source.for_filename(filename).tree
+
+    class Frame(object):
+        f_lineno = 2
+        f_globals = {}
+
+    report("run", "us")
+    for run in range(5):
+        # A new code object each time, so its decoded instructions aren't cached
+        frame = Frame()
+        frame.f_code = compile(text, filename, "exec").co_consts[0]
+        calls = [inst.offset for inst in dis.get_instructions(frame.f_code) if inst.opname == "CALL"]
+        frame.f_lasti = calls[len(calls) // 2]
+        gc.collect()
+        start = time.perf_counter()
+        Source.executing(frame)
+        report(run, "%.0f" % ((time.perf_counter() - start) * 1e6))
+
+
+@benchmark
+def warm_hits():
+    """
+    Calls per second of Source.executing for a position whose result is already cached,
+    like icecream or varname calling it repeatedly from the same place,
+    compared to an empty function taking the frame.
+    """
+    calls = 200000
+
+    def empty(frame):
+        pass
+
+    def run(func):
+        frame = sys._getframe()
+        start = time.perf_counter()
+        for _ in range(calls):
+            func(frame)
+        return calls / (time.perf_counter() - start)
+
+    report("", "calls/sec")
+    for _ in range(3):
+        for name, func in [("Source.executing", Source.executing), ("empty function", empty)]:
+            run(func)  # warm up the cache
+            report(name, "%.0f" % run(func))
+
+
+@benchmark
+def stored_results():
+    """
+    Bytes retained per stored result when keeping 1,000 results
+    from calls whose frames each had a 10kB local variable.
+    """
+    import tracemalloc
+
+    def f(get):
+        local = bytearray(10000)
+        return get(Source.executing(sys._getframe()))
+
+    def executing(ex):
+        return ex
+
+    def info(ex):
+        return ex.info
+
+    f(executing)  # warm up the cache
+    report("", "bytes per result")
+    for get in [executing, info]:
+        gc.collect()
+        tracemalloc.start()
+        results = [f(get) for _ in range(1000)]
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report(get.__name__, size // len(results))
+        del results
+
+
+@benchmark
+def monitoring_events():
+    """
+    Events per second handled by executing.monitoring.NodeMonitor (Python 3.12+).
+    First for every instruction of every code object in tests/samples,
+    calling the handler directly: cold when each code object is first resolved, then warm.
+    Then for CALL events from running a function, through sys.monitoring,
+    compared to registering a callback that does nothing.
+    """
+    if sys.version_info < (3, 12):
+        print("Needs Python 3.12+")
+        return
+
+    from executing.monitoring import NodeMonitor
+
+    events = sys.monitoring.events
+
+    def callback(event, code, offset, info, *args):
+        pass
+
+    class MonitorSource(Source):
+        pass
+
+    samples = os.path.join(os.path.dirname(__file__), "samples")
+    positions = []
+    for name in sorted(os.listdir(samples)):
+        filename = os.path.join(samples, name)
+        try:
+            codes = [compile("".join(linecache.getlines(filename)), filename, "exec")]
+        except SyntaxError:
+            continue
+        for code in codes:
+            codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+            positions.extend((code, inst.offset) for inst in dis.get_instructions(code))
+
+    handle = NodeMonitor(callback, events.INSTRUCTION, MonitorSource)._handler(events.INSTRUCTION)
+    report("", "events", "events/sec")
+    for name in ["cold", "warm", "warm"]:
+        start = time.perf_counter()
+        for code, offset in positions:
+            handle(code, offset)
+        report(name, len(positions), "%.0f" % (len(positions) / (time.perf_counter() - start)))
+
+    def workload():
+        total = 0
+        for i in range(100000):
+            total += abs(-i) + len(str(i))
+        return total
+
+    class Counter(object):
+        count = 0
+
+    def count_call(code, offset, callable, arg0):
+        Counter.count += 1
+
+    def count_node(event, code, offset, info, *args):
+        Counter.count += 1
+
+    def bare_monitoring():
+        sys.monitoring.use_tool_id(3, "benchmark")
+        sys.monitoring.register_callback(3, events.CALL, count_call)
+        sys.monitoring.set_events(3, events.CALL)
+        try:
+            workload()
+        finally:
+            sys.monitoring.set_events(3, 0)
+            sys.monitoring.register_callback(3, events.CALL, None)
+            sys.monitoring.free_tool_id(3)
+
+    def node_monitor():
+        with NodeMonitor(count_node, events.CALL, MonitorSource, tool_id=3):
+            workload()
+
+    for func in [bare_monitoring, node_monitor]:
+        Counter.count = 0
+        start = time.perf_counter()
+        func()
+        report(func.__name__, Counter.count, "%.0f" % (Counter.count / (time.perf_counter() - start)))
+
+
+@benchmark
+def expression_coverage():
+    """
+    Milliseconds to run a workload (resolving all of tests/samples/bird.py with executing_map)
+    with no tracing, with line coverage from sys.monitoring LINE events disabled after
+    their first time like coverage.py, and with executing.coverage.ExpressionCoverage
+    (Python 3.12+). Then the time for ExpressionCoverage.report() to map the offsets to nodes.
+    """
+    if sys.version_info < (3, 12):
+        print("Needs Python 3.12+")
+        return
+
+    from executing.coverage import ExpressionCoverage
+
+    events = sys.monitoring.events
+    filename = os.path.join(os.path.dirname(__file__), "samples", "bird.py")
+    codes = [compile("".join(linecache.getlines(filename)), filename, "exec")]
+    for code in codes:
+        codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+
+    def workload():
+        class WorkloadSource(Source):
+            pass
+
+        for code in codes:
+            WorkloadSource.executing_map(code)
+
+    def no_tracing():
+        workload()
+
+    def line_coverage():
+        lines = set()
+
+        def line(code, line_number):
+            lines.add((code, line_number))
+            return sys.monitoring.DISABLE
+
+        sys.monitoring.use_tool_id(3, "benchmark")
+        sys.monitoring.register_callback(3, events.LINE, line)
+        sys.monitoring.restart_events()
+        sys.monitoring.set_events(3, events.LINE)
+        try:
+            workload()
+        finally:
+            sys.monitoring.set_events(3, 0)
+            sys.monitoring.register_callback(3, events.LINE, None)
+            sys.monitoring.free_tool_id(3)
+
+    coverage = ExpressionCoverage(tool_id=3)
+
+    def expression_coverage():
+        with coverage:
+            workload()
+
+    report("", "ms")
+    for func in [no_tracing, line_coverage, expression_coverage]:
+        start = time.perf_counter()
+        func()
+        report(func.__name__, "%.0f" % ((time.perf_counter() - start) * 1000))
+
+    start = time.perf_counter()
+    result = coverage.report()
+    elapsed = time.perf_counter() - start
+    report("report()", "%.0f" % (elapsed * 1000))
+    print("%d files, %d covered and %d uncovered expressions" % (
+        len(result),
+        sum(len(file_coverage.covered) for file_coverage in result.values()),
+        sum(len(file_coverage.uncovered) for file_coverage in result.values()),
+    ))
+
+
+@benchmark
+def node_text():
+    """
+    Milliseconds (best of 5) and kB of memory kept for the first text of a node in the middle
+    of a fresh Source, using asttokens.ASTText compared to Source.get_text,
+    for a small module and for tests/samples/datetime.py repeated to grow the file.
+    """
+    import tracemalloc
+
+    filename = os.path.join(os.path.dirname(__file__), "samples", "datetime.py")
+    datetime_text = "".join(linecache.getlines(filename))
+    small = "import sys\n\ndef f(x):\n    return sys.modules[x].__name__ + '!'\n"
+
+    report("lines", "asttokens ms", "native ms", "asttokens kB", "native kB")
+    for text in [small, datetime_text, datetime_text * 4]:
+        lines = text.splitlines(True)
+        source = Source("<node_text_benchmark>", lines)
+        statement = source.tree.body[len(source.tree.body) // 2]
+        node = [node for node in ast.walk(statement) if hasattr(node, "end_lineno")][-1]
+
+        row = [len(lines)]
+        sizes = []
+        for get_text in [
+            lambda source: source.asttext().get_text(node),
+            lambda source: source.get_text(node),
+        ]:
+            times = []
+            for _ in range(5):
+                source = Source("<node_text_benchmark>", lines)
+                start = time.perf_counter()
+                get_text(source)
+                times.append(time.perf_counter() - start)
+            row.append("%.3f" % (min(times) * 1000))
+
+            source = Source("<node_text_benchmark>", lines)
+            gc.collect()
+            tracemalloc.start()
+            get_text(source)
+            gc.collect()
+            sizes.append("%.1f" % (tracemalloc.get_traced_memory()[0] / 1000))
+            tracemalloc.stop()
+        report(*(row + sizes))
+
+
+@benchmark
+def opcode_tracer():
+    """
+    Milliseconds to run a workload under sys.settrace with f_trace_opcodes, looking up
+    the executing node of every opcode event with Source.executing(frame) and with
+    Source.executing_table bound in the 'call' event, compared to a tracer which does nothing
+    and to no tracing. Caches are warmed first.
+    """
+
+    def workload():
+        total = 0
+        for i in range(20000):
+            point = types.SimpleNamespace(x=i, y=[i, i + 1])
+            total += point.x * len(point.y) + point.y[1] % 7
+        return total
+
+    def noop_tracer(frame, event, arg):
+        frame.f_trace_opcodes = True
+        return noop_tracer
+
+    def executing_tracer(frame, event, arg):
+        frame.f_trace_opcodes = True
+        if event == "opcode":
+            Source.executing(frame).node
+        return executing_tracer
+
+    def table_tracer(frame, event, arg):
+        frame.f_trace_opcodes = True
+        table = Source.executing_table(frame.f_code)
+
+        def local_tracer(frame, event, arg):
+            if event == "opcode":
+                table[frame.f_lasti]
+            return local_tracer
+
+        return local_tracer
+
+    def run(tracer):
+        old = sys.gettrace()
+        sys.settrace(tracer)
+        try:
+            workload()
+        finally:
+            sys.settrace(old)
+
+    executing.executing.TESTING = False
+    run(executing_tracer)
+    run(table_tracer)
+
+    start = time.perf_counter()
+    workload()
+    untraced = time.perf_counter() - start
+
+    report("", "ms", "x untraced")
+    report("untraced", "%.0f" % (untraced * 1000), "1.0")
+    for tracer in [noop_tracer, executing_tracer, table_tracer]:
+        start = time.perf_counter()
+        run(tracer)
+        elapsed = time.perf_counter() - start
+        report(tracer.__name__, "%.0f" % (elapsed * 1000), "%.1f" % (elapsed / untraced))
+
+
+@benchmark
+def node_sampling():
+    """
+    Microseconds per executing.sampling.NodeSampler.sample() with 4 threads
+    blocked 30 frames deep, compared to only calling sys._current_frames()
+    and to walking the stacks to record f_lineno. Then the time for report().
+    """
+    import threading
+    from executing.sampling import NodeSampler
+
+    def recurse(n, event):
+        if n:
+            return recurse(n - 1, event) or None
+        return event.wait()
+
+    event = threading.Event()
+    threads = [threading.Thread(target=recurse, args=(30, event)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+
+    def current_frames():
+        sys._current_frames()
+
+    lines = {}
+
+    def line_numbers():
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                key = (frame.f_code, frame.f_lineno)
+                lines[key] = lines.get(key, 0) + 1
+                frame = frame.f_back
+
+    sampler = NodeSampler()
+    n = 10000
+    try:
+        report("", "us/sample")
+        for name, func in [
+            ("_current_frames", current_frames),
+            ("f_lineno", line_numbers),
+            ("NodeSampler", sampler.sample),
+        ]:
+            start = time.perf_counter()
+            for _ in range(n):
+                func()
+            report(name, "%.1f" % ((time.perf_counter() - start) / n * 1e6))
+    finally:
+        event.set()
+        for thread in threads:
+            thread.join()
+
+    executing.executing.TESTING = False
+    start = time.perf_counter()
+    stats = sampler.report()
+    report("report()", "%.1f ms" % ((time.perf_counter() - start) * 1000))
+    print("%d nodes and lines from %d positions" % (
+        len(stats), sum(len(offsets) for _, offsets in sampler.counts.values())
+    ))
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        func = BENCHMARKS[name]
+        print(name + ":", inspect.cleandoc(func.__doc__))
+        func()
+        print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -59,9 +59,7 @@ def test_file(filename: Path):
     # Clear caches to avoid accumulating too much data in memory.
     # This is usually not a problem for executing, but this usage scenario is different
     linecache.clearcache()
-    for cache_name in ("__source_cache_with_lines", "__executing_cache"):
-        if hasattr(Source, cache_name):
-            delattr(Source, cache_name)
+    Source.clear_cache()
 
     test = TestFiles()
     try:
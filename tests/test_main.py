@@ -5,6 +5,8 @@ import contextlib
 import dis
 import inspect
 import json
+import linecache
+import marshal
 import os
 import re
 import sys
@@ -19,12 +21,13 @@ from executing._utils import mangled_name
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-from .utils import tester, subscript_item, in_finally, start_position, end_position
+from .utils import tester, subscript_item, in_finally, start_position, end_position, not_testing, linecache_text
 
 PYPY = 'pypy' in sys.version.lower()
 
-from executing import Source, only, NotOneValueFound
-from executing.executing import NodeFinder, get_instructions, function_node_types
+import executing.executing
+from executing import Executing, Source, only, NotOneValueFound
+from executing.executing import NodeFinder, get_instructions, function_node_types, node_linenos
 
 from executing._exceptions import VerifierFailure, KnownIssue
 
@@ -535,6 +538,1203 @@ class TestStuff(unittest.TestCase):
         check(3)
         check(5)
 
+    def test_nodes_by_line(self):
+        nested = 'x = f(\n' * 5 + '[\n' + '    (a.b,\n c), [1,\n 2],\n' * 20 + ']' + ')' * 5 + '; y = (\n1)\n'
+        for source in [
+            Source.for_filename(__file__),
+            Source('<nested>', nested.splitlines(True)),
+        ]:
+            expected = defaultdict(set)
+            for node in ast.walk(source.tree):
+                for lineno in node_linenos(node):
+                    expected[lineno].add(node)
+
+            for lineno in range(len(source.lines) + 2):
+                nodes = source._nodes_by_line[lineno]
+                self.assertEqual(len(nodes), len(set(nodes)))
+                self.assertEqual(set(nodes), expected[lineno])
+
+    def test_lazy_indexing(self):
+        filename = inspect.currentframe().f_code.co_filename
+        lines = linecache.getlines(filename)
+        lazy = Source(filename, lines)
+        eager = Source(filename, lines)
+        self.assertIsNotNone(eager.tree)
+
+        lineno = inspect.currentframe().f_lineno
+        self.assertEqual(
+            [type(stmt) for stmt in lazy.statements_at_line(lineno)],
+            [ast.Assign],
+        )
+        # Only the class containing this method has been indexed
+        indexes = lazy._nodes_by_line.indexes
+        self.assertEqual(len(indexes) - indexes.count(None), 1)
+        self.assertEqual(lazy.code_qualname(C.D.h().__code__), 'C.D.h.<locals>.i.<locals>.j')
+        self.assertEqual(len(indexes) - indexes.count(None), 2)
+
+        def positions(nodes):
+            return sorted(
+                (type(node).__name__, node.lineno, node.col_offset)
+                for node in nodes
+            )
+
+        for lineno in reversed(range(len(lines) + 1)):
+            self.assertEqual(
+                positions(lazy._nodes_by_line[lineno]),
+                positions(eager._nodes_by_line[lineno]),
+            )
+        self.assertEqual(lazy._qualnames, eager._qualnames)
+
+    def test_assign_tree(self):
+        filename = "<assign_tree_test>"
+
+        def code_named(module_code, name):
+            codes = [module_code]
+            for code in codes:
+                codes.extend(const for const in code.co_consts if inspect.iscode(const))
+            return next(code for code in codes if code.co_name == name)
+
+        source = Source(filename, ["def f():\n", "    return 1\n"])
+        self.assertEqual(source.code_qualname(code_named(compile("def f(): pass", filename, "exec"), "f")), "f")
+
+        # Assigning a tree replaces the index, which is then built lazily for it
+        tree = ast.parse("class A:\n    def f(self): return 1\n")
+        source.tree = tree
+        self.assertEqual(source._nodes_by_line.indexes, [None])
+        stmts = source.statements_at_line(2)
+        self.assertEqual({type(stmt) for stmt in stmts}, {ast.FunctionDef, ast.Return})
+        self.assertEqual({stmt.parent for stmt in stmts}, {tree.body[0], tree.body[0].body[0]})
+        self.assertEqual(source.code_qualname(code_named(compile(tree, filename, "exec"), "f")), "A.f")
+        self.assertIs(source.tree, tree)
+
+        source.tree = None
+        self.assertIsNone(source.tree)
+        self.assertEqual(source.statements_at_line(2), set())
+
+    def test_source_cache_limits(self):
+        class LimitedSource(Source):
+            max_cached_sources = 2
+
+        filenames = []
+        for i in range(3):
+            _, filename = tempfile.mkstemp()
+            with open(filename, 'w') as outfile:
+                outfile.write('x = %s\n' % i)
+            filenames.append(filename)
+
+        sources = [LimitedSource.for_filename(filename) for filename in filenames]
+        self.assertIs(LimitedSource.for_filename(filenames[2]), sources[2])
+
+        # The least recently used source was evicted and is rebuilt transparently,
+        # which in turn evicts the source for filenames[1]
+        rebuilt = LimitedSource.for_filename(filenames[0])
+        self.assertIsNot(rebuilt, sources[0])
+        self.assertEqual(rebuilt.text, sources[0].text)
+        self.assertIs(LimitedSource.for_filename(filenames[0]), rebuilt)
+        self.assertIsNot(LimitedSource.for_filename(filenames[1]), sources[1])
+
+        LimitedSource.max_cached_sources = None
+        LimitedSource.max_cached_bytes = 1
+        source = LimitedSource.for_filename(filenames[2])
+        # The most recently added source is always kept
+        self.assertIs(LimitedSource.for_filename(filenames[2]), source)
+        LimitedSource.for_filename(filenames[1])
+        self.assertIsNot(LimitedSource.for_filename(filenames[2]), source)
+
+    def test_for_filename_fast_path(self):
+        class FastSource(Source):
+            slow_lookups = 0
+
+            @classmethod
+            def _for_filename_and_lines(cls, filename, lines):
+                cls.slow_lookups += 1
+                return super(FastSource, cls)._for_filename_and_lines(filename, lines)
+
+        filename = inspect.currentframe().f_code.co_filename
+        source = FastSource.for_filename(filename)
+        for _ in range(3):
+            self.assertIs(FastSource.for_filename(filename), source)
+        self.assertEqual(FastSource.slow_lookups, 1)
+
+        # A new linecache entry with the same lines still gives the same source
+        size, mtime, lines, fullname = linecache.cache[filename]
+        linecache.cache[filename] = (size, mtime, list(lines), fullname)
+        for _ in range(3):
+            self.assertIs(FastSource.for_filename(filename), source)
+        self.assertEqual(FastSource.slow_lookups, 2)
+
+    def test_linecache_check_interval(self):
+        class ThrottledSource(Source):
+            linecache_check_interval = 60
+
+        _, filename = tempfile.mkstemp()
+
+        def write(text):
+            with open(filename, 'w') as outfile:
+                outfile.write(text)
+
+        write('x = 1\n')
+        source = ThrottledSource.for_filename(filename)
+        write('x = 22\n')
+        # The change isn't noticed within the interval...
+        self.assertIs(ThrottledSource.for_filename(filename), source)
+        # ...unless all files are explicitly checked
+        ThrottledSource.revalidate()
+        source = ThrottledSource.for_filename(filename)
+        self.assertEqual(source.text, 'x = 22\n')
+
+        ThrottledSource.linecache_check_interval = None
+        write('x = 333\n')
+        self.assertIs(ThrottledSource.for_filename(filename), source)
+        ThrottledSource.revalidate()
+        self.assertEqual(ThrottledSource.for_filename(filename).text, 'x = 333\n')
+
+    def test_source_cache_invalidate(self):
+        class InvalidatedSource(Source):
+            pass
+
+        frame = inspect.currentframe()
+        results = []
+        for i in range(3):
+            if i == 1:
+                InvalidatedSource.invalidate(frame.f_code.co_filename)
+            results.append(InvalidatedSource.executing(frame))
+
+        self.assertIsNot(results[0].source, results[1].source)
+        self.assertIsNot(results[0].node, results[1].node)
+        self.assertEqual(ast.dump(results[0].node), ast.dump(results[1].node))
+        self.assertIs(results[1].node, results[2].node)
+
+        InvalidatedSource.clear_cache()
+        ex = InvalidatedSource.executing(frame)
+        self.assertIsNot(ex.source, results[2].source)
+        self.assertEqual(ex.source.text, results[2].source.text)
+
+    def test_executing_cache_by_source(self):
+        class IndexedSource(Source):
+            evict = False
+
+            def _find_node(self, code, lineno, lasti):
+                info = super(IndexedSource, self)._find_node(code, lineno, lasti)
+                if IndexedSource.evict:
+                    # As if another thread evicted the source while the node was being found
+                    IndexedSource.invalidate(code.co_filename)
+                return info
+
+        def other():
+            return len([])
+
+        frame = inspect.currentframe()
+        code, lasti = frame.f_code, frame.f_lasti
+        executing_cache = IndexedSource._executing_cache()
+        info = IndexedSource.executing_at(code, lasti)
+        self.assertEqual(executing_cache.by_source, {id(info.source): (info.source, {id(code)})})
+
+        IndexedSource.invalidate(code.co_filename)
+        self.assertEqual(executing_cache.by_source, {})
+        self.assertNotIn(lasti, executing_cache.codes[id(code)][1])
+
+        # A result whose source was evicted in the meantime isn't cached
+        IndexedSource.evict = True
+        late = IndexedSource.executing_at(code, lasti)
+        self.assertEqual(ast.dump(late.node), ast.dump(info.node))
+        self.assertNotIn(lasti, executing_cache.codes[id(code)][1])
+        self.assertEqual(executing_cache.by_source, {})
+        with not_testing():
+            self.assertIsNot(IndexedSource.executing_table(code), IndexedSource.executing_table(code))
+
+        IndexedSource.evict = False
+        again = IndexedSource.executing_at(code, lasti)
+        self.assertIsNot(again.source, late.source)
+        self.assertIs(IndexedSource.executing_at(code, lasti), again)
+        self.assertEqual(executing_cache.by_source, {id(again.source): (again.source, {id(code)})})
+
+        # Evicted code objects are removed from the index
+        IndexedSource.max_cached_codes = 1
+        with not_testing():
+            IndexedSource.executing_map(other.__code__)
+        self.assertEqual(executing_cache.by_source, {id(again.source): (again.source, {id(other.__code__)})})
+
+    def test_disk_cache(self):
+        filename = os.path.join(os.path.dirname(__file__), "samples", "datetime.py")
+        lines = linecache.getlines(filename)
+        expected = Source(filename, lines)
+        expected_tree = expected.tree
+
+        with tempfile.TemporaryDirectory() as directory:
+            class DiskCachedSource(Source):
+                disk_cache_dir = directory
+
+            saving = DiskCachedSource(filename, lines)
+            self.assertIsNone(saving._nodes_by_line.tables)
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            loaded = DiskCachedSource(filename, lines)
+            self.assertIsNotNone(loaded._nodes_by_line.tables)
+            # Qualnames are available without indexing anything
+            self.assertEqual(loaded._qualnames, expected._qualnames)
+            self.assertEqual(loaded._nodes_by_line.indexes, [None] * len(loaded._tree.body))
+
+            for lineno in range(1, len(lines) + 1):
+                self.assertEqual(
+                    sorted(start_position(stmt) for stmt in loaded.statements_at_line(lineno)),
+                    sorted(start_position(stmt) for stmt in expected.statements_at_line(lineno)),
+                )
+            def parent_positions(tree):
+                nodes = list(ast.walk(tree))
+                positions = {id(node): i for i, node in enumerate(nodes)}
+                # Other nodes such as ast.Load() are singletons shared between trees
+                return [positions[id(node.parent)] for node in nodes[1:] if hasattr(node, "lineno")]
+
+            self.assertEqual(parent_positions(loaded.tree), parent_positions(expected_tree))
+
+            # Unreadable files are ignored and replaced
+            path = os.path.join(directory, os.listdir(directory)[0])
+            with open(path, "wb") as f:
+                f.write(b"not marshal data")
+            self.assertIsNone(DiskCachedSource(filename, lines)._nodes_by_line.tables)
+            self.assertIsNotNone(DiskCachedSource(filename, lines)._nodes_by_line.tables)
+
+            # So are truncated files
+            with open(path, "rb") as f:
+                content = f.read()
+            with open(path, "wb") as f:
+                f.write(content[:len(content) // 2])
+            self.assertIsNone(DiskCachedSource(filename, lines)._nodes_by_line.tables)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), content)
+
+            # Tables with indices that don't fit the nodes are replaced by indexing the nodes
+            starts, ends, qualnames, tables = marshal.loads(content)
+            count, starting, spanning = tables[0]
+            bad_tables = [(count, [(lineno, [count]) for lineno, _ in starting], spanning)] + tables[1:]
+            with open(path, "wb") as f:
+                marshal.dump((starts, ends, qualnames, bad_tables), f)
+            loaded = DiskCachedSource(filename, lines)
+            self.assertIsNotNone(loaded._nodes_by_line.tables)
+            stmt = loaded._tree.body[0]
+            self.assertEqual(
+                [start_position(node) for node in loaded._nodes_by_line[stmt.lineno]],
+                [start_position(node) for node in expected._nodes_by_line[stmt.lineno]],
+            )
+
+            # Data of the wrong types isn't loaded at all
+            with open(path, "wb") as f:
+                marshal.dump((starts, ends, [(1, 2, 3)], tables), f)
+            self.assertIsNone(DiskCachedSource(filename, lines)._nodes_by_line.tables)
+
+            # A failed write doesn't leave its temporary file behind
+            from executing import _disk_cache
+            cache_path = _disk_cache.cache_path
+
+            def failing_cache_path(directory, text):
+                raise RuntimeError
+
+            _disk_cache.cache_path = failing_cache_path
+            try:
+                with self.assertRaises(RuntimeError):
+                    _disk_cache.save(directory, "x = 1\n", [])
+            finally:
+                _disk_cache.cache_path = cache_path
+            self.assertEqual(os.listdir(directory), [os.path.basename(path)])
+
+    def test_executing_map(self):
+        class MapSource(Source):
+            pass
+
+        class FrameSource(Source):
+            pass
+
+        def node_key(node):
+            return node and (type(node), start_position(node), end_position(node))
+
+        text = '''
+@foo.bar(baz(1))
+@spam
+def func(x, y=f(2)):
+    return [g(a) + x.b for a in y] + [
+        h(x)[y] and not z,
+    ]
+'''
+        filename = "<executing_map_test>"
+        with linecache_text(filename, text):
+            codes = [compile(text, filename, "exec")]
+            for code in codes:
+                codes.extend(const for const in code.co_consts if inspect.iscode(const))
+
+            with not_testing():
+                for code in codes:
+                    mapping = MapSource.executing_map(code)
+                    self.assertEqual(
+                        list(mapping),
+                        [inst.offset for inst in dis.get_instructions(code)],
+                    )
+
+                    linestarts = dict(dis.findlinestarts(code))
+                    lineno = code.co_firstlineno
+                    for offset, (node, decorator) in mapping.items():
+                        lineno = linestarts.get(offset, lineno)
+                        frame = C()
+                        frame.f_lasti = offset
+                        frame.f_code = code
+                        frame.f_globals = globals()
+                        frame.f_lineno = lineno
+                        ex = FrameSource.executing(frame)
+                        self.assertEqual(node_key(node), node_key(ex.node))
+                        self.assertEqual(node_key(decorator), node_key(ex.decorator))
+
+                        # The results are cached for executing
+                        ex = MapSource.executing(frame)
+                        self.assertIs(ex.node, node)
+                        self.assertIs(ex.decorator, decorator)
+
+            self.assertEqual(
+                [type(decorator) for _, decorator in MapSource.executing_map(codes[0]).values() if decorator],
+                [ast.Name, ast.Call],
+            )
+
+    def test_executing_many(self):
+        class ManySource(Source):
+            pass
+
+        def recurse(n):
+            if n:
+                return recurse(n - 1)
+            return 1 / n
+
+        try:
+            recurse(10)
+        except ZeroDivisionError:
+            tb = sys.exc_info()[2]
+
+        results = ManySource.executing_many(tb)
+        tbs = []
+        while tb:
+            tbs.append(tb)
+            tb = tb.tb_next
+        self.assertEqual(len(results), 12)
+        self.assertEqual([ex.frame for ex in results], [tb.tb_frame for tb in tbs])
+        self.assertEqual(
+            [start_position(ex.node) for ex in results],
+            [start_position(Source.executing(tb).node) for tb in tbs],
+        )
+        self.assertIsInstance(results[0].node, ast.Call)
+        self.assertIsInstance(results[-1].node, ast.BinOp)
+        self.assertEqual(len({ex.node for ex in results[1:-1]}), 1)
+
+        # Cached results are shared with executing
+        self.assertIs(ManySource.executing(tbs[3]).node, results[3].node)
+
+        frames = [tb.tb_frame for tb in tbs]
+        self.assertEqual(
+            [ex.frame for ex in ManySource.executing_many(reversed(frames))],
+            frames[::-1],
+        )
+
+    def test_executing_cache_weak(self):
+        import gc
+        import weakref
+
+        class WeakSource(Source):
+            max_cached_codes = 2
+
+        def make_function(i):
+            namespace = {"inspect": inspect}
+            exec("def f():\n    return inspect.currentframe()\n", namespace)
+            frame = namespace["f"]()
+            self.assertIsNone(WeakSource.executing(frame).node)
+            return namespace["f"], frame
+
+        func, frame = make_function(0)
+        code_ref = weakref.ref(func.__code__)
+        codes = WeakSource._executing_cache().codes
+        self.assertEqual(list(codes), [id(func.__code__)])
+
+        del func, frame
+        gc.collect()
+        self.assertIsNone(code_ref())
+        self.assertEqual(len(codes), 0)
+
+        functions = [make_function(i)[0] for i in range(3)]
+        self.assertEqual(list(codes), [id(f.__code__) for f in functions[1:]])
+
+    def test_evicted_sources_collected(self):
+        import gc
+        import weakref
+
+        class EvictedSource(Source):
+            pass
+
+        frame = inspect.currentframe()
+        ex = EvictedSource.executing(frame)
+        self.assertIsInstance(ex.node, ast.Call)
+        index = ex.source._nodes_by_line
+        self.assertIs(index.statement_containing(ex.node), only(ex.statements))
+        self.assertIs(index.statement_containing(ex.node.func), only(ex.statements))
+        source_ref = weakref.ref(ex.source)
+        node_ref = weakref.ref(ex.node)
+
+        del ex, index
+        EvictedSource.clear_cache()
+        gc.collect()
+        self.assertIsNone(source_ref())
+        self.assertIsNone(node_ref())
+
+    def test_single_flight(self):
+        import threading
+
+        calls = defaultdict(int)
+
+        class CountingSource(Source):
+            def __init__(self, *args):
+                calls["init"] += 1
+                super(CountingSource, self).__init__(*args)
+
+            def _find_node(self, *args):
+                calls["find"] += 1
+                time.sleep(0.01)
+                return super(CountingSource, self)._find_node(*args)
+
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            # Unlike the current frame, this doesn't move while the threads run
+            tb = sys.exc_info()[2]
+
+        barrier = threading.Barrier(16)
+        results = []
+
+        def run():
+            barrier.wait()
+            results.append(CountingSource.executing(tb))
+
+        threads = [threading.Thread(target=run) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, {"init": 1, "find": 1})
+        self.assertEqual(len(results), 16)
+        self.assertEqual({id(ex.node) for ex in results}, {id(results[0].node)})
+        self.assertIsInstance(results[0].node, ast.BinOp)
+
+    @unittest.skipIf(sys.version_info >= (3, 11), "SentinelNodeFinder is only used before 3.11")
+    def test_sentinel_shared_tree_untouched(self):
+        class FreshSource(Source):
+            pass
+
+        source = FreshSource.for_frame(sys._getframe())
+        original = ast.dump(source.tree, include_attributes=True)
+        compiled = []
+        compile_similar_to = executing.executing.compile_similar_to
+
+        def checking_compile(tree, code):
+            # Another thread could be reading source.tree right now
+            self.assertEqual(ast.dump(source.tree, include_attributes=True), original)
+            compiled.append(tree)
+            return compile_similar_to(tree, code)
+
+        def get_node():
+            return FreshSource.executing(sys._getframe(1)).node
+
+        executing.executing.compile_similar_to = checking_compile
+        try:
+            node = [get_node(), get_node()][1]
+        finally:
+            executing.executing.compile_similar_to = compile_similar_to
+
+        self.assertIsInstance(node, ast.Call)
+        self.assertEqual(node.parent.elts.index(node), 1)
+        self.assertTrue(any(tree is not source.tree for tree in compiled))
+        self.assertEqual(ast.dump(source.tree, include_attributes=True), original)
+
+    @unittest.skipIf(sys.version_info >= (3, 11), "SentinelNodeFinder is only used before 3.11")
+    def test_sentinel_table(self):
+        text = "def func(a, c, e, g):\n    return f(a.b, c.d, e.f, g.h)\n"
+        filename = "<sentinel_table_test>"
+        with linecache_text(filename, text):
+            code = next(
+                const
+                for const in compile(text, filename, "exec").co_consts
+                if inspect.iscode(const)
+            )
+
+            class TableSource(Source):
+                pass
+
+            compiled = []
+            compile_similar_to = executing.executing.compile_similar_to
+
+            def counting_compile(tree, code):
+                compiled.append(tree)
+                return compile_similar_to(tree, code)
+
+            def executing_at(inst):
+                return TableSource.executing_at(code, inst.offset, 2, globals()).node
+
+            executing.executing.compile_similar_to = counting_compile
+            try:
+                instructions = list(dis.get_instructions(code))
+                attributes = [inst for inst in instructions if inst.opname == "LOAD_ATTR"]
+                self.assertEqual(
+                    [executing_at(inst).attr for inst in attributes],
+                    ["b", "d", "f", "h"],
+                )
+                # All four candidates are found by compiling the function once
+                self.assertEqual(len(compiled), 1)
+
+                call = executing_at(next(inst for inst in instructions if inst.opname.startswith("CALL")))
+                self.assertEqual(call.func.id, "f")
+                self.assertEqual(len(compiled), 2)
+            finally:
+                executing.executing.compile_similar_to = compile_similar_to
+
+    def test_warm_executing(self):
+        calls = []
+
+        class WarmSource(Source):
+            @classmethod
+            def _class_local(cls, name, default):
+                calls.append(name)
+                return super(WarmSource, cls)._class_local(name, default)
+
+            @classmethod
+            def _executing_cache(cls):
+                calls.append("_executing_cache")
+                return super(WarmSource, cls)._executing_cache()
+
+        frame_position = executing.executing.frame_position
+
+        def counting_frame_position(frame_or_tb):
+            calls.append("frame_position")
+            return frame_position(frame_or_tb)
+
+        executing.executing.frame_position = counting_frame_position
+        try:
+            frame = inspect.currentframe()
+            results = []
+            for _ in range(3):
+                results.append(WarmSource.executing(frame))
+                if not results[1:]:
+                    self.assertIn("frame_position", calls)
+                    del calls[:]
+        finally:
+            executing.executing.frame_position = frame_position
+
+        # Cached results are found without any of the slower helpers
+        self.assertEqual(calls, [])
+        self.assertIsInstance(results[0].node, ast.Call)
+        self.assertEqual(len({(id(ex.node), id(ex.source)) for ex in results}), 1)
+
+    def test_executing_info(self):
+        import gc
+        import weakref
+        from executing import ExecutingInfo
+
+        class Local(object):
+            pass
+
+        def f():
+            local = Local()
+            return Source.executing(inspect.currentframe()).info, weakref.ref(local)
+
+        info, local_ref = f()
+        gc.collect()
+        # Keeping the info doesn't keep the frame's locals alive
+        self.assertIsNone(local_ref())
+        self.assertIsInstance(info, ExecutingInfo)
+        self.assertIsInstance(info.node, ast.Call)
+        self.assertIs(info.code, f.__code__)
+        self.assertEqual(info.code_qualname(), f.__qualname__)
+        self.assertIs(f()[0], info)
+
+        with self.assertRaises(AttributeError):
+            info.node = None
+        with self.assertRaises(AttributeError):
+            info.extra = 1
+
+        ex = Source.executing(inspect.currentframe())
+        self.assertFalse(hasattr(ex, "__dict__"))
+        self.assertIs(ex.node, ex.info.node)
+        self.assertIs(ex.source, ex.info.source)
+        self.assertEqual(ex.statements, ex.info.statements)
+        self.assertIsNone(ex.decorator)
+
+    def test_executing_constructor(self):
+        frame = inspect.currentframe()
+        # Both from the same instruction, so they share the cached info
+        results = []
+        for _ in range(2):
+            results.append(Source.executing(frame))
+        cached, fresh = results
+        self.assertIs(cached.info, fresh.info)
+        source = cached.source
+        node = cached.node
+
+        # The public constructor still takes the pieces separately
+        ex = Executing(frame, source, node, {node.parent}, None)
+        self.assertIs(ex.frame, frame)
+        self.assertIs(ex.source, source)
+        self.assertIs(ex.node, node)
+        self.assertEqual(ex.statements, {node.parent})
+        self.assertIsNone(ex.decorator)
+        self.assertEqual(ex.text(), cached.text())
+        self.assertIs(ex.info.code, frame.f_code)
+
+        # Setting attributes changes a copy of the info, not the cached one
+        cached.node = None
+        cached.decorator = node
+        self.assertIsNone(cached.node)
+        self.assertIs(cached.decorator, node)
+        self.assertIs(cached.source, source)
+        self.assertIsNot(cached.info, fresh.info)
+        self.assertIs(fresh.node, node)
+        self.assertIsNone(fresh.decorator)
+
+        self.assertIs(Executing.from_info(frame, fresh.info).info, fresh.info)
+        with self.assertRaises(TypeError):
+            fresh.info._replace(nodes=None)
+
+    def test_executing_at(self):
+        class AtSource(Source):
+            pass
+
+        frame = inspect.currentframe()
+        lasti = frame.f_lasti
+        info = AtSource.executing_at(frame.f_code, lasti)
+        # What was executing when f_lasti was read
+        self.assertIsInstance(info.node, ast.Attribute)
+        self.assertEqual(info.node.attr, "f_lasti")
+        self.assertIs(AtSource.executing_at(frame.f_code, lasti), info)
+        # Shares the cache with executing
+        self.assertIs(AtSource._executing_cache().offsets(frame.f_code, None)[lasti], info)
+
+        # Offsets that no frame could have are rejected instead of being looked up
+        for bad_lasti in [-1, 3, len(frame.f_code.co_code)]:
+            with self.assertRaises(ValueError):
+                AtSource.executing_at(frame.f_code, bad_lasti)
+
+        def node_key(node):
+            return node and (type(node), start_position(node), end_position(node))
+
+        text = "@foo.bar(baz(1))\ndef func(x, y=f(2)):\n    return [g(a) + x.b for a in y]\n"
+        filename = "<executing_at_test>"
+        with linecache_text(filename, text):
+            code = compile(text, filename, "exec")
+
+            with not_testing():
+                expected = {
+                    offset: tuple(map(node_key, pair))
+                    for offset, pair in Source.executing_map(code).items()
+                }
+                actual = {}
+                infos = []
+                for inst in dis.get_instructions(code):
+                    # The line number is computed from the code
+                    info = AtSource.executing_at(code, inst.offset)
+                    infos.append(info)
+                    actual[inst.offset] = node_key(info.node), node_key(info.decorator)
+            self.assertEqual(actual, expected)
+
+            func_def = AtSource.for_filename(filename).tree.body[0]
+            decorator = func_def.decorator_list[0]
+            self.assertEqual(
+                [info.node for info in infos if isinstance(info.node, (ast.Call, ast.Attribute))],
+                [decorator.func, decorator.args[0], decorator, func_def.args.defaults[0]],
+            )
+            self.assertEqual(
+                [(info.node, info.decorator) for info in infos if info.decorator],
+                [(func_def, decorator)],
+            )
+
+    @pytest.mark.skipif(sys.version_info < (3, 12), reason="needs sys.monitoring")
+    def test_node_monitor(self):
+        from executing.monitoring import NodeMonitor
+
+        events = sys.monitoring.events
+        seen = []
+
+        def callback(event, code, offset, info, *args):
+            if code is target.__code__:
+                seen.append((event, info.node, args))
+
+        def target():
+            x = len([1, 2])
+            try:
+                int("a")
+            except ValueError:
+                pass
+            return str(x)
+
+        # Events come from all code, including pytest's,
+        # where failures should give None like in real code instead of raising
+        with not_testing():
+            with NodeMonitor(callback, events.CALL | events.RAISE) as monitor:
+                tool_id = monitor.active_tool_id
+                self.assertEqual(sys.monitoring.get_tool(tool_id), "executing")
+                target()
+                target()
+        self.assertIsNone(sys.monitoring.get_tool(tool_id))
+
+        calls = [(event, node.func.id, args[0]) for event, node, args in seen]
+        self.assertEqual(
+            calls[:4],
+            [
+                (events.CALL, "len", len),
+                (events.CALL, "int", int),
+                (events.RAISE, "int", calls[2][2]),
+                (events.CALL, "str", str),
+            ],
+        )
+        self.assertIsInstance(calls[2][2], ValueError)
+        # The second run gets the same cached nodes
+        self.assertEqual([node for _, node, _ in seen[4:]], [node for _, node, _ in seen[:4]])
+
+        with self.assertRaises(ValueError):
+            NodeMonitor(callback, events.LINE)
+
+    def test_expression_coverage(self):
+        from executing.coverage import expression_coverage
+
+        text = "def f(flag):\n    return g(1) if flag else h(2)\n\ndef unused():\n    return k(3)\n"
+        filename = "<expression_coverage_test>"
+        with linecache_text(filename, text):
+            module_code = compile(text, filename, "exec")
+            code = next(const for const in module_code.co_consts if inspect.iscode(const))
+
+            class CoverageSource(Source):
+                pass
+
+            with not_testing():
+                # As if only the g(1) branch had run
+                executed = [(
+                    code,
+                    [
+                        offset
+                        for offset, (node, _) in CoverageSource.executing_map(code).items()
+                        if node and node.lineno == 2 and node.col_offset < 16
+                    ],
+                )]
+                result = expression_coverage(executed, CoverageSource)
+            self.assertEqual(list(result), [filename])
+            coverage = result[filename]
+            self.assertIs(coverage.source, CoverageSource.for_filename(filename))
+
+            def texts(nodes):
+                return [coverage.source.text.splitlines()[node.lineno - 1][node.col_offset:node.end_col_offset] for node in nodes]
+
+            self.assertIn("g(1)", texts(coverage.covered))
+            self.assertNotIn("h(2)", texts(coverage.covered))
+            # Including code that never ran
+            self.assertIn("h(2)", texts(coverage.uncovered))
+            self.assertIn("k(3)", texts(coverage.uncovered))
+
+    def test_expression_coverage_identical_files(self):
+        from executing.coverage import expression_coverage
+
+        # Code objects from different files compare equal if the code is the same
+        text = "def f(x):\n    return x.y\n"
+        filenames = ["<expression_coverage_file_a>", "<expression_coverage_file_b>"]
+        with contextlib.ExitStack() as stack:
+            functions = []
+            for filename in filenames:
+                stack.enter_context(linecache_text(filename, text))
+                namespace = {}
+                exec(compile(text, filename, "exec"), namespace)
+                functions.append(namespace["f"])
+            codes = [function.__code__ for function in functions]
+            self.assertEqual(codes[0], codes[1])
+
+            class CoverageSource(Source):
+                pass
+
+            with not_testing():
+                result = expression_coverage(
+                    [(code, list(CoverageSource.executing_map(code))) for code in codes],
+                    CoverageSource,
+                )
+
+            def covered_texts(file_coverage):
+                return [file_coverage.source.get_text(node) for node in file_coverage.covered]
+
+            self.assertEqual(sorted(result), filenames)
+            for filename in filenames:
+                self.assertEqual(covered_texts(result[filename]), ["x", "x.y"])
+
+            if sys.version_info < (3, 12):
+                return
+
+            from executing.coverage import ExpressionCoverage
+
+            class Obj(object):
+                y = 1
+
+            with ExpressionCoverage() as coverage:
+                for function in functions:
+                    function(Obj)
+            executed = [(code, offsets) for code, offsets in coverage.executed() if code.co_filename in filenames]
+            self.assertEqual(len(executed), 2)
+            with not_testing():
+                result = expression_coverage(executed)
+            for filename in filenames:
+                self.assertEqual(covered_texts(result[filename]), ["x", "x.y"])
+
+    @pytest.mark.skipif(sys.version_info < (3, 12), reason="needs sys.monitoring")
+    def test_expression_coverage_collector(self):
+        from executing.coverage import ExpressionCoverage, expression_coverage
+
+        text = "def f(xs, flag):\n    ok = flag and check(xs)\n    return [x for x in xs if x > 1]\n\ndef check(a):\n    return a\n"
+        filename = "<expression_coverage_collector_test>"
+        with linecache_text(filename, text):
+            namespace = {}
+            exec(compile(text, filename, "exec"), namespace)
+
+            with ExpressionCoverage() as coverage:
+                tool_id = coverage.active_tool_id
+                namespace["f"]([1, 2], False)
+                namespace["f"]([1, 2], False)
+            self.assertIsNone(sys.monitoring.get_tool(tool_id))
+
+            executed = [(code, offsets) for code, offsets in coverage.executed() if code.co_filename == filename]
+            self.assertEqual({code.co_name for code, _ in executed} - {"<listcomp>"}, {"f"})
+            with not_testing():
+                result = expression_coverage(executed)[filename]
+            covered = {ast.unparse(node) for node in result.covered}
+            uncovered = {ast.unparse(node) for node in result.uncovered}
+            self.assertIn("x > 1", covered)
+            self.assertIn("flag and check(xs)", covered)
+            self.assertIn("check(xs)", uncovered)
+            self.assertIn("a", uncovered)
+
+    def test_get_text(self):
+        text = u"""\
+@deco(été)
+class A(B):
+    x = f"{a.b!r:>{width}} ü {c}" ; y = 1  # comment
+    def f(self, *args, k=1):
+        with open(p) as fp, g():
+            return [ñ + "中文".z for ñ in args[1:2]]
+    try:
+        pass
+    except E as e:
+        w = lambda: e  # comment
+
+s = 'abc' \\
+    .upper()
+"""
+        filename = "<get_text_test>"
+        with linecache_text(filename, text):
+            class TextSource(Source):
+                pass
+
+            source = TextSource.for_filename(filename)
+            # Nodes which asttokens needs tokens for go last
+            nodes = sorted(
+                ast.walk(source.tree),
+                key=lambda node: type(node).__name__ in executing.executing.tokens_needed_types,
+            )
+            native = []
+            for node in nodes:
+                if type(node).__name__ in executing.executing.tokens_needed_types:
+                    break
+                native.append((source.get_text_range(node), source.get_text(node)))
+            # Nothing needed asttokens so far
+            self.assertIsNone(source._asttext)
+            for node in nodes[len(native):]:
+                native.append((source.get_text_range(node), source.get_text(node)))
+            asttext = source.asttext()
+            for node, (text_range, node_text) in zip(nodes, native):
+                self.assertEqual(text_range, asttext.get_text_range(node))
+                self.assertEqual(node_text, asttext.get_text(node))
+
+            texts = {node_text for _, node_text in native}
+            self.assertIn(u'"中文".z', texts)
+            self.assertIn(u"ñ + \"中文\".z", texts)
+            self.assertIn("'abc' \\\n    .upper()", texts)
+            # The class including its decorator, without the trailing comment
+            self.assertIn(text.split("  # comment\n\ns")[0], texts)
+            self.assertEqual(source.get_text(None), "")
+            self.assertEqual(source.get_text_range(source.tree), (0, len(text)))
+
+    def test_executing_table(self):
+        text = "def f(a):\n    b = a.x + len(a.y)\n    return [b * i for i in a.z]\n"
+        filename = "<executing_table_test>"
+        with linecache_text(filename, text):
+            namespace = {}
+            exec(compile(text, filename, "exec"), namespace)
+            code = namespace["f"].__code__
+
+            class TableSource(Source):
+                pass
+
+            with not_testing():
+                table = TableSource.executing_table(code)
+                self.assertIs(TableSource.executing_table(code), table)
+                self.assertEqual(len(table), len(code.co_code) + 1)
+                self.assertIsNone(table[-1])
+                mapping = TableSource.executing_map(code)
+                self.assertEqual(
+                    {lasti for lasti, info in enumerate(table) if info is not None},
+                    set(mapping),
+                )
+                for lasti, (node, decorator) in mapping.items():
+                    self.assertIs(table[lasti].node, node)
+                    self.assertIs(table[lasti].decorator, decorator)
+
+                # A tracer with opcode events gets the same results as executing(frame)
+                found = []
+
+                def tracer(frame, event, arg):
+                    if frame.f_code is not code:
+                        return None
+                    frame.f_trace_opcodes = True
+                    if event in ("line", "opcode"):
+                        found.append((event, table[frame.f_lasti], TableSource.executing(frame).info))
+                    return tracer
+
+                class Obj(object):
+                    x = 1
+                    y = [1, 2]
+                    z = [3, 4]
+
+                old_trace = sys.gettrace()
+                sys.settrace(tracer)
+                try:
+                    namespace["f"](Obj)
+                finally:
+                    sys.settrace(old_trace)
+                self.assertGreater(len(found), 2)
+                for _, from_table, info in found:
+                    self.assertIs(from_table, info)
+                # Python 3.12.1 doesn't generate opcode events when the trace function sets f_trace_opcodes
+                if any(event == "opcode" for event, _, _ in found):
+                    self.assertIn("a.x", {info.text() for _, info, _ in found if info.node})
+
+                TableSource.clear_cache()
+                self.assertIsNot(TableSource.executing_table(code), table)
+
+    def test_node_sampler(self):
+        import threading
+        from executing.sampling import NodeSampler
+
+        text = "def f(event):\n    return str(event.wait())\n"
+        filename = "<node_sampler_test>"
+        with linecache_text(filename, text):
+            namespace = {}
+            exec(compile(text, filename, "exec"), namespace)
+
+            started = threading.Event()
+            event = threading.Event()
+            thread = threading.Thread(target=lambda: started.set() or namespace["f"](event))
+            thread.start()
+            started.wait()
+            time.sleep(0.01)
+
+            class SamplerSource(Source):
+                pass
+
+            sampler = NodeSampler(source_class=SamplerSource)
+            try:
+                # The sampling thread itself is skipped
+                for _ in range(3):
+                    sampler.sample()
+            finally:
+                event.set()
+                thread.join()
+            self.assertEqual(sampler.samples, 3)
+
+            with not_testing():
+                stats = sampler.report()
+            (wait,) = [s for s in stats if s.code.co_filename == filename]
+            self.assertIs(wait.source, SamplerSource.for_filename(filename))
+            self.assertEqual(wait.code.co_name, "f")
+            self.assertEqual(wait.text(), "event.wait()")
+            self.assertEqual(wait.lineno, 2)
+            self.assertEqual((wait.own_samples, wait.total_samples), (0, 3))
+            self.assertEqual(sum(s.own_samples for s in stats), 3)
+            self.assertEqual(
+                [s.total_samples for s in stats],
+                sorted((s.total_samples for s in stats), reverse=True),
+            )
+
+            with NodeSampler(interval=0.0001) as sampler:
+                time.sleep(0.05)
+            self.assertIsNone(sampler.thread)
+            self.assertGreater(sampler.samples, 0)
+
+    @pytest.mark.skipif(sys.version_info >= (3, 11), reason="PositionNodeFinder doesn't handle IPython cells")
+    def test_ipython_statements_on_one_line(self):
+        text = "x = f(a.b); y = g(c.d)\n"
+        filename = "<ipython-input-1-abcdef>"
+        with linecache_text(filename, text):
+            class IPythonSource(Source):
+                pass
+
+            source = IPythonSource.for_filename(filename)
+            texts = []
+            # Like IPython, compile each statement of the cell separately
+            for stmt in ast.parse(text).body:
+                module = ast.parse("")
+                module.body = [stmt]
+                code = compile(module, filename, "exec")
+                mapping = IPythonSource.executing_map(code)
+                texts.append(sorted(
+                    source.get_text(node)
+                    for node, _ in mapping.values()
+                    if isinstance(node, (ast.Call, ast.Attribute))
+                ))
+
+                # The sentinel tables only wrapped nodes of the statement that was compiled
+                original_stmt = source.tree.body[len(texts) - 1]
+                tables = source._sentinel_tables[code]
+                self.assertTrue(tables)
+                for (_, _, stmts), table in tables.items():
+                    self.assertEqual(stmts, {original_stmt})
+                    self.assertIsNotNone(table)
+                    nodes = set(ast.walk(original_stmt))
+                    for candidates in table.values():
+                        self.assertTrue(nodes.issuperset(candidates))
+            self.assertEqual(texts, [["a.b", "f(a.b)"], ["c.d", "g(c.d)"]])
+
+    def test_code_info(self):
+        import gc
+        from executing.executing import code_info, code_infos
+
+        code = compile("x = [a.b for a in y]\n", "<code_info_test>", "exec")
+        info = code_info(code)
+        self.assertIs(code_info(code), info)
+        # Equal code objects from another file get their own info
+        self.assertIsNot(
+            code_info(compile("x = [a.b for a in y]\n", "<code_info_test_2>", "exec")),
+            info,
+        )
+
+        instructions = list(dis.get_instructions(code))
+        self.assertEqual(info.instruction_offsets, [inst.offset for inst in instructions])
+        for inst in instructions:
+            self.assertEqual(info.opnames[info.offsets[inst.offset]], inst.opname)
+        if sys.version_info >= (3, 11):
+            # Only decoded on demand by PositionNodeFinder
+            self.assertEqual(info.instructions, [])
+        else:
+            self.assertEqual([inst.offset for inst in info.instructions], info.instruction_offsets)
+        self.assertNotIn("NOP", [inst.opname for inst in info.clean_instructions])
+        self.assertFalse(info.is_pytest)
+        self.assertFalse(info.is_ipython_cell)
+
+        key = id(code)
+        self.assertIn(key, code_infos)
+        del code
+        gc.collect()
+        self.assertNotIn(key, code_infos)
+
+    @pytest.mark.skipif(sys.version_info < (3, 11), reason="PositionNodeFinder only")
+    def test_decode_instruction(self):
+        from executing.executing import code_info
+        from executing._position_node_finder import decode_instruction
+
+        # Long enough for EXTENDED_ARGs, with jumps both ways
+        text = "def f(x):\n    for i in x:\n        if i:\n            x.a = [i]\n"
+        text += "".join("    y%d = x.b%d(i, z=%d)\n" % (i, i, i) for i in range(300))
+        code = compile(text, "<decode_instruction_test>", "exec").co_consts[0]
+        info = code_info(code)
+        instructions = list(dis.get_instructions(code))
+        self.assertIn("EXTENDED_ARG", info.opnames)
+
+        for i, expected in enumerate(instructions):
+            inst = decode_instruction(code, info, i)
+            self.assertEqual(
+                (inst.opname, inst.opcode, inst.arg, inst.argval, inst.offset, inst.positions),
+                (expected.opname, expected.opcode, expected.arg, expected.argval,
+                 expected.offset, expected.positions),
+            )
+            if inst.opcode not in dis.hasjrel + getattr(dis, "hasjump", []):
+                self.assertEqual(inst.argrepr, expected.argrepr)
+
+    def test_position_index(self):
+        source = Source.for_filename(__file__)
+        index = source._nodes_by_line
+        for node in ast.walk(source.tree):
+            if not hasattr(node, "lineno"):
+                continue
+            overlapping = index[node.lineno]
+            self.assertEqual(
+                set(map(id, index.nodes_at(*start_position(node), *end_position(node)))),
+                {
+                    id(other)
+                    for other in overlapping
+                    if start_position(other) == start_position(node)
+                    if end_position(other) == end_position(node)
+                },
+            )
+            self.assertEqual(
+                set(map(id, index.nodes_ending_at(node.lineno, *end_position(node)))),
+                {id(other) for other in overlapping if end_position(other) == end_position(node)},
+            )
+
+    def test_copy_scope(self):
+        from executing.executing import copy_scope, enclosing_scope
+
+        text = """
+x = 1
+
+def outer():
+    y = 2
+
+    class A:
+        z = 3
+
+        def other(self):
+            pass
+
+        def method(self):
+            return y + z
+
+    return A
+"""
+        source = Source("<copy_scope_test>", text.splitlines(True))
+        tree = source.tree
+        original = ast.dump(tree, include_attributes=True)
+        outer = tree.body[1]
+        method = outer.body[1].body[2]
+
+        self.assertIsNone(enclosing_scope([tree.body[0]]))
+        self.assertIs(enclosing_scope(method.body), method)
+        self.assertIs(enclosing_scope([method, method.body[0]]), outer.body[1])
+
+        module = copy_scope(tree, method)
+        self.assertEqual(len(module.body), 1)
+        # Enclosing functions are kept whole, other statements in classes are left out
+        self.assertEqual(len(module.body[0].body), 3)
+        self.assertEqual(module.body[0].body[1].body, [method])
+        self.assertEqual(ast.dump(tree, include_attributes=True), original)
+
+        def method_code(tree):
+            code = compile(tree, "<copy_scope_test>", "exec")
+            for name in ["outer", "A", "method"]:
+                code = next(c for c in code.co_consts if getattr(c, "co_name", None) == name)
+            return code
+
+        expected = method_code(tree)
+        actual = method_code(module)
+        self.assertEqual(actual.co_code, expected.co_code)
+        self.assertEqual(actual.co_freevars, ("y",))
+        self.assertEqual(actual.co_firstlineno, expected.co_firstlineno)
+
+        # A tree holding only some of the statements, as for IPython cells.
+        # Nodes outside it can't be wrapped.
+        from executing.executing import _extract_ipython_statement
+
+        def wrap(node):
+            return ast.copy_location(ast.Constant(value="wrapped"), node)
+
+        partial_tree = _extract_ipython_statement(tree.body[0])
+        module = copy_scope(partial_tree, None, {tree.body[0].value: wrap, method.body[0].value: wrap})
+        self.assertEqual(len(module.body), 1)
+        self.assertEqual(module.body[0].value.value, "wrapped")
+        self.assertEqual(ast.dump(tree, include_attributes=True), original)
+
     @contextlib.contextmanager
     def assert_name_error(self):
         try:
@@ -1,7 +1,9 @@
 import sys
 import ast
 import inspect
+import linecache
 from collections import namedtuple
+from contextlib import contextmanager
 
 import executing.executing
 
@@ -213,3 +215,30 @@ def end_position(obj):
         obj=obj.body[-1]
 
     return SourcePosition(obj.end_lineno, obj.end_col_offset)
+
+
+@contextmanager
+def not_testing():
+    """
+    Sets executing.executing.TESTING to False, so that like in real code
+    failures give None instead of raising, and restores it afterwards.
+    """
+    testing = executing.executing.TESTING
+    executing.executing.TESTING = False
+    try:
+        yield
+    finally:
+        executing.executing.TESTING = testing
+
+
+@contextmanager
+def linecache_text(filename, text):
+    """
+    Makes text the source of the fake file filename in linecache, where Source looks for it,
+    and removes it again afterwards.
+    """
+    linecache.cache[filename] = (len(text), None, text.splitlines(True), filename)
+    try:
+        yield
+    finally:
+        linecache.cache.pop(filename, None)